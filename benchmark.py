@@ -0,0 +1,135 @@
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import statistics
+import time
+from urllib.parse import parse_qs
+
+import uvicorn
+from telegram import Bot
+from telegram.constants import ParseMode
+
+from main import BOT_API_HTTP_VERSION, build_bot_request
+
+# main configures INFO logging, under which httpx logs every request to the fake API
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+# Number fan-out benchmark: sends draws to many players through a local fake Bot API with a fixed response latency.
+# Compares Bot API connection pool settings without touching Telegram. The fake API runs in its own process so it
+# does not compete with the sender for the event loop. With --serve it only runs the fake API, as a stand-in for a
+# local telegram-bot-api server: BOT_API_BASE_URL=http://127.0.0.1:8765/bot BOT_API_LOCAL_MODE=1 python main.py
+
+class FakeBotApi:
+    def __init__(self, latency):
+        self.latency = latency
+        self.in_flight = 0
+        self.peak = 0
+        self.message_id = 0
+        self.webhook_url = ''
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return
+        body = b''
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get('body', b'')
+            more_body = message.get('more_body', False)
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency)
+        finally:
+            self.in_flight -= 1
+
+        method = scope['path'].rsplit('/', 1)[-1]
+        if method == 'stats':
+            # Peak concurrent requests since the last call, i.e. connections the client really used
+            result = {'peak': self.peak - 1}
+            self.peak = 0
+        elif method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Lotto', 'username': 'lotto_bench_bot'}
+        elif method == 'getWebhookInfo':
+            result = {'url': self.webhook_url, 'has_custom_certificate': False, 'pending_update_count': 0}
+        elif method == 'setWebhook':
+            self.webhook_url = parse_qs(body.decode()).get('url', [''])[0]
+            print(f"setWebhook {self.webhook_url}")
+            result = True
+        elif method in ('deleteMessages', 'deleteMessage', 'answerCallbackQuery', 'deleteWebhook'):
+            result = True
+        elif method == 'sendPhoto':
+            self.message_id += 1
+            photo = {'file_id': f'photo{self.message_id}', 'file_unique_id': f'u{self.message_id}', 'width': 1, 'height': 1}
+            result = {'message_id': self.message_id, 'date': int(time.time()), 'chat': {'id': 1, 'type': 'private'}, 'photo': [photo]}
+        else:
+            self.message_id += 1
+            result = {'message_id': self.message_id, 'date': int(time.time()), 'chat': {'id': 1, 'type': 'private'}}
+        body = json.dumps({'ok': True, 'result': result}).encode()
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]})
+        await send({'type': 'http.response.body', 'body': body})
+
+def serve_fake_api(port, latency):
+    uvicorn.run(FakeBotApi(latency), host="127.0.0.1", port=port, log_level="warning", lifespan="off", backlog=4096)
+
+async def run_setting(args, pool_size):
+    bot = Bot("1:bench", base_url=f"http://127.0.0.1:{args.port}/bot", request=build_bot_request(pool_size, args.http_version))
+    await bot.initialize()
+    await bot.do_api_request('stats')
+    durations = []
+    errors = 0
+    started = time.perf_counter()
+    for num in range(1, args.draws + 1):
+        # Same shape as draw_next: one send per player, all gathered at once
+        draw_started = time.perf_counter()
+        results = await asyncio.gather(*(bot.send_message(user_id, f"🎲 ԹԻՎ՝ *{num}*", parse_mode=ParseMode.MARKDOWN)
+                                         for user_id in range(1, args.players + 1)), return_exceptions=True)
+        durations.append(time.perf_counter() - draw_started)
+        errors += sum(1 for result in results if isinstance(result, Exception))
+    elapsed = time.perf_counter() - started
+    peak = (await bot.do_api_request('stats'))['peak']
+    await bot.shutdown()
+
+    sent = args.draws * args.players - errors
+    durations.sort()
+    p90 = durations[int(0.9 * (len(durations) - 1))]
+    print(f"{pool_size:>6} {sent / elapsed:>10.0f} {statistics.median(durations) * 1000:>9.0f}ms {p90 * 1000:>8.0f}ms "
+          f"{peak:>6} {errors:>7}")
+
+async def run(args):
+    print(f"{args.players} players, {args.draws} draws, {args.latency * 1000:.0f}ms API latency, HTTP/{args.http_version}")
+    print("Sends go through a bare Bot, bypassing the app's OutboundRateLimiter\n")
+    print(f"{'pool':>6} {'msgs/s':>10} {'p50 draw':>11} {'p90 draw':>10} {'conns':>6} {'errors':>7}")
+    for pool_size in args.pool_sizes:
+        await run_setting(args, pool_size)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark number fan-out throughput per Bot API pool setting.")
+    parser.add_argument("--players", type=int, default=500, help="players receiving every number")
+    parser.add_argument("--draws", type=int, default=10, help="numbers drawn per setting")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds the fake API takes per request")
+    parser.add_argument("--pool-sizes", type=lambda value: [int(p) for p in value.split(',')], default=[16, 64, 256, 512],
+                        help="comma-separated connection pool sizes to compare")
+    parser.add_argument("--http-version", default=BOT_API_HTTP_VERSION,
+                        help="1.1 or 2; the local plain-HTTP fake API always answers over HTTP/1.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--serve", action="store_true", help="only run the fake Bot API until interrupted")
+    args = parser.parse_args()
+
+    if args.serve:
+        serve_fake_api(args.port, args.latency)
+        return
+
+    server = multiprocessing.Process(target=serve_fake_api, args=(args.port, args.latency), daemon=True)
+    server.start()
+    time.sleep(1)
+    try:
+        asyncio.run(run(args))
+    finally:
+        server.terminate()
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,31 @@
 import random
+import bisect
+import heapq
 import time
+import json
+import hashlib
+import hmac
+import struct
+import pickle
 import uuid
 import os
 import logging
 import asyncio
+import sys
+import contextlib
+import itertools
+from collections import OrderedDict, deque
 import aiosqlite
+import uvicorn
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, ReplyKeyboardRemove
 from telegram.ext import (
     Application,
+    BasePersistence,
+    BaseRateLimiter,
+    BaseUpdateProcessor,
+    CallbackContext,
+    PersistenceInput,
+    TypeHandler,
     CommandHandler,
     CallbackQueryHandler,
     MessageHandler,
@@ -15,6 +33,8 @@ from telegram.ext import (
     ContextTypes,
 )
 from telegram.constants import ParseMode
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+from telegram.request import HTTPXRequest
 
 # Set up logging
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
@@ -24,6 +44,7 @@ logger = logging.getLogger(__name__)
 MIN_PLAYERS = 2
 GAME_PAUSE = 10  # 10 seconds for private friend games
 PUBLIC_GAME_PAUSE = 60  # 60 seconds for public games
+COUNTDOWN_MIN_INTERVAL = 5  # Shortest gap between countdown edits, also the rounding step of the shown time
 MAX_NUMBER = 80
 ADMIN_ID = 1878495685  # Replace with your admin user ID
 
@@ -31,11 +52,130 @@ ADMIN_ID = 1878495685  # Replace with your admin user ID
 PUBLIC_DRAW_INTERVAL = 5  # Seconds between drawn numbers in public games
 PRIVATE_DRAW_INTERVAL = 5 # Seconds between drawn numbers in private games
 
+# Card rendering
+CARD_RENDER_MODE = os.getenv("CARD_RENDER_MODE", "keyboard")  # Default for users who did not pick one: "keyboard" or "text"
+CARD_MARK = "[]"  # Two single-width characters, the width of a number cell in the monospaced text card
+MAX_CARDS_PER_PLAYER = 6
+CARDS_PER_PLAYER = min(max(int(os.getenv("CARDS_PER_PLAYER", 1)), 1), MAX_CARDS_PER_PLAYER)  # Default for users who did not pick a count with /cards
+CARDS_PER_MESSAGE = 3  # Keyboard mode; three 3x8 grids plus labels stay under Telegram's 100-button limit
+SCHEDULER_TICK = 0.05  # Deadlines this close together fire in one pass of the game scheduler
+DRAW_MAX_FAILURES = 3  # Consecutive transient draw errors before the game is aborted
+
+# Stale game sweeper
+LIVE_STATUSES = ('waiting', 'preparing', 'running')
+LIVE_STATUS_SQL = ', '.join(f"'{status}'" for status in LIVE_STATUSES)  # Inlined into queries as status IN (...)
+STALE_SWEEP_INTERVAL = int(os.getenv("STALE_SWEEP_INTERVAL", 300))  # Seconds between sweeps
+STALE_WAITING_TIMEOUT = int(os.getenv("STALE_WAITING_TIMEOUT", 3600))  # Idle waiting/preparing games expire after this
+STALE_RUNNING_TIMEOUT = int(os.getenv("STALE_RUNNING_TIMEOUT", 900))  # Running games without a draw expire after this
+STALE_SWEEP_BATCH = int(os.getenv("STALE_SWEEP_BATCH", 100))  # Max games expired per sweep
+
+# Warm restart
+SNAPSHOT_INTERVAL = float(os.getenv("SNAPSHOT_INTERVAL", 2))  # Seconds between live game snapshots
+
 # Configuration
 BOT_TOKEN = os.getenv("BOT_TOKEN", "7325788973:AAFX0CIPGLUVIWR10RD40Qp2IoWYFuboD2E")
 WEBHOOK_URL = os.getenv("WEBHOOK_URL", "https://lottogram.onrender.com")
 PORT = int(os.getenv("PORT", 10000))
 DB_PATH = "lotto.db"  # Persistent disk path for Render
+SCHEMA_VERSION = 9  # Bump whenever init_db creates or alters a table
+DB_READERS = int(os.getenv("DB_READERS", 4))  # Read-only connections for lookups, next to the single writer
+DB_STATEMENT_CACHE = 256  # Prepared statements kept per connection; every IN-list length is a statement of its own
+
+# Webhook ingress
+WEBHOOK_SERVER = os.getenv("WEBHOOK_SERVER", "asgi")  # "asgi" (uvicorn ingress) or "ptb" (built-in updater)
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/")
+WEBHOOK_LOOP = os.getenv("WEBHOOK_LOOP", "auto")  # uvicorn loop setup: auto, asyncio or uvloop
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN") or None
+WEBHOOK_DROP_PENDING = os.getenv("WEBHOOK_DROP_PENDING", "0") == "1"  # Discard updates queued while the bot was down
+METRICS_TOKEN = os.getenv("METRICS_TOKEN") or WEBHOOK_SECRET_TOKEN  # Bearer token for GET /metrics; unset hides the endpoint
+
+# Bot API endpoint; point these at a self-hosted telegram-bot-api server to run in local mode
+BOT_API_BASE_URL = os.getenv("BOT_API_BASE_URL", "https://api.telegram.org/bot")
+BOT_API_BASE_FILE_URL = os.getenv("BOT_API_BASE_FILE_URL", "https://api.telegram.org/file/bot")
+BOT_API_LOCAL_MODE = os.getenv("BOT_API_LOCAL_MODE", "0") == "1"  # Local server: files by path, plain-HTTP webhooks on any port
+AD_MEDIA_DIR = os.getenv("AD_MEDIA_DIR", "ads")  # Local mode only: /add_ad <file> picks ad photos from this directory
+if BOT_API_LOCAL_MODE:
+    # The local server sits next to the bot and delivers updates directly, not through the public URL
+    WEBHOOK_URL = os.getenv("LOCAL_WEBHOOK_URL", f"http://127.0.0.1:{PORT}{WEBHOOK_PATH}")
+
+# Bot API HTTP client
+BOT_API_POOL_SIZE = int(os.getenv("BOT_API_POOL_SIZE", 256))  # Concurrent connections (and kept-alive ones) to the Bot API
+BOT_API_CONNECT_TIMEOUT = float(os.getenv("BOT_API_CONNECT_TIMEOUT", 5))
+BOT_API_READ_TIMEOUT = float(os.getenv("BOT_API_READ_TIMEOUT", 5))
+BOT_API_WRITE_TIMEOUT = float(os.getenv("BOT_API_WRITE_TIMEOUT", 5))
+BOT_API_POOL_TIMEOUT = float(os.getenv("BOT_API_POOL_TIMEOUT", 5))  # How long a send may wait for a free connection
+BOT_API_HTTP_VERSION = os.getenv("BOT_API_HTTP_VERSION", "1.1")  # "1.1" or "2" (needs python-telegram-bot[http2])
+
+# Update processing
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", 64))  # Global cap on updates handled at once
+
+# Message cleanup
+CLEANUP_BATCH_SIZE = 100  # Bot API limit for a single deleteMessages call
+
+# Outbound rate budget; sends and edits use it up unthrottled, the message cleaner's deletes get what is left
+OUTBOUND_RATE = float(os.getenv("OUTBOUND_RATE", 30))  # Message calls per second across all chats; 0 disables cleanup pacing
+OUTBOUND_BURST = int(os.getenv("OUTBOUND_BURST", 30))  # Calls allowed back to back after an idle spell
+
+# Ephemeral state limits
+USER_STATE_MAX = int(os.getenv("USER_STATE_MAX", 50000))  # Users kept in memory before the least recent is evicted
+USER_STATE_TTL = int(os.getenv("USER_STATE_TTL", 86400))  # Seconds a user's state lives without activity
+GAME_STATE_MAX = int(os.getenv("GAME_STATE_MAX", 10000))
+GAME_STATE_TTL = int(os.getenv("GAME_STATE_TTL", 3600))
+MAX_TRACKED_MESSAGES = int(os.getenv("MAX_TRACKED_MESSAGES", 20))  # Tracked cleanup message ids per chat
+STATE_SIZE_SAMPLE = 100  # Entries measured per store to estimate its memory use
+GAME_CACHE_MAX = int(os.getenv("GAME_CACHE_MAX", 10000))  # Live game rows cached for get_game_by_id
+GAME_CACHE_TTL = int(os.getenv("GAME_CACHE_TTL", 300))  # Seconds an unused cached row is kept; writes invalidate rows directly
+
+# Persistence
+PERSISTENCE_UPDATE_INTERVAL = float(os.getenv("PERSISTENCE_UPDATE_INTERVAL", 10))  # How often PTB hands changed data to the persistence
+PERSISTENCE_FLUSH_INTERVAL = float(os.getenv("PERSISTENCE_FLUSH_INTERVAL", 10))  # How often dirty rows are written to SQLite
+
+# Card pool
+CARD_POOL_SIZE = int(os.getenv("CARD_POOL_SIZE", 500))  # Unclaimed pre-generated cards kept ready for joins
+CARD_POOL_REFILL_INTERVAL = float(os.getenv("CARD_POOL_REFILL_INTERVAL", 5))  # Seconds between pool top-ups
+CARD_POOL_BATCH = 100  # Cards generated and inserted per transaction while refilling
+
+# Game event journal
+JOURNAL_DIR = os.getenv("JOURNAL_DIR", "journal")  # One append-only file of binary event frames per game
+JOURNAL_COMMIT_INTERVAL = float(os.getenv("JOURNAL_COMMIT_INTERVAL", 0.005))  # Seconds events gather before one write+fsync
+JOURNAL_RETENTION = int(os.getenv("JOURNAL_RETENTION", 30 * 86400))  # Seconds finished game journals are kept for disputes
+JOURNAL_FRAME = struct.Struct('<HBdq')  # payload length, event type, timestamp, user_id
+EVENT_DRAW, EVENT_MARK, EVENT_JOIN, EVENT_LEAVE, EVENT_WIN = 1, 2, 3, 4, 5
+
+# Outbox for critical messages that hit a transient send error
+OUTBOX_MAX_ENTRIES = int(os.getenv("OUTBOX_MAX_ENTRIES", 10000))  # Oldest queued messages are dropped beyond this
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", 8))
+OUTBOX_BACKOFF = float(os.getenv("OUTBOX_BACKOFF", 1))  # First retry delay in seconds, doubled on every failure
+OUTBOX_MAX_BACKOFF = float(os.getenv("OUTBOX_MAX_BACKOFF", 60))
+OUTBOX_RATE = float(os.getenv("OUTBOX_RATE", 20))  # Max retried messages per second
+OUTBOX_TTL = int(os.getenv("OUTBOX_TTL", 3600))  # Seconds after which an undelivered start or result message is dropped
+OUTBOX_NUMBER_TTL = int(os.getenv("OUTBOX_NUMBER_TTL", 60))  # Drawn numbers go stale much sooner
+
+# In-flight draw state per game_id: remaining shuffle, drawn sequence and number message ids
+LIVE_GAMES = {}
+
+# Marks recorded in the game journal but not yet folded into the cards table: card_id -> (marked_numbers, marked_time)
+PENDING_MARKS = {}
+
+# Users whose chat is unreachable (bot blocked or chat gone); skipped by every fan-out until they /start again
+BLOCKED_USERS = set()
+
+# Per-game locks serializing read-modify-write of a game's players/waiting_players lists; game_id -> [lock, users]
+_membership_locks = {}
+
+# Counters exposed on the /metrics route
+METRICS = {
+    'webhook_updates': 0,
+    'webhook_rejected': 0,
+    'card_pool_claims': 0,
+    'card_pool_misses': 0,
+    'outbox_queued': 0,
+    'outbox_delivered': 0,
+    'outbox_dropped': 0,
+    'sends_skipped_blocked': 0,
+    'game_cache_hits': 0,
+    'game_cache_misses': 0,
+}
 
 # Check token
 if not BOT_TOKEN:
@@ -51,13 +191,22 @@ async def init_db():
             logger.info(f"Created directory for database: {db_dir}")
 
         async with aiosqlite.connect(DB_PATH, timeout=10) as conn:
+            # Skip schema probing when the file was already migrated to this version
+            async with conn.execute("PRAGMA user_version") as cursor:
+                (schema_version,) = await cursor.fetchone()
+            if schema_version == SCHEMA_VERSION:
+                logger.info(f"Database schema is up to date (version {SCHEMA_VERSION})")
+                return
+            
             await conn.execute("PRAGMA journal_mode = WAL")
             await conn.execute("PRAGMA synchronous = NORMAL")
             
             await conn.execute('''CREATE TABLE IF NOT EXISTS users (
                 user_id INTEGER PRIMARY KEY,
                 username TEXT,
-                balance INTEGER DEFAULT 0
+                balance INTEGER DEFAULT 0,
+                full_name TEXT,
+                blocked INTEGER DEFAULT 0
             )''')
             
             await conn.execute('''CREATE TABLE IF NOT EXISTS cards (
@@ -80,7 +229,33 @@ async def init_db():
                 start_time REAL,
                 waiting_players TEXT DEFAULT '',
                 invite_code TEXT DEFAULT '',
-                is_private INTEGER DEFAULT 0
+                is_private INTEGER DEFAULT 0,
+                updated_at REAL,
+                chat_id INTEGER
+            )''')
+            
+            await conn.execute('''CREATE TABLE IF NOT EXISTS game_snapshots (
+                game_id TEXT PRIMARY KEY,
+                data TEXT,
+                updated_at REAL
+            )''')
+            
+            await conn.execute('''CREATE TABLE IF NOT EXISTS persistence (
+                kind TEXT,
+                key TEXT,
+                data BLOB,
+                PRIMARY KEY (kind, key)
+            )''')
+            
+            await conn.execute('''CREATE TABLE IF NOT EXISTS outbox (
+                key TEXT PRIMARY KEY,
+                chat_id INTEGER,
+                text TEXT,
+                parse_mode TEXT,
+                reply_markup TEXT,
+                attempts INTEGER DEFAULT 0,
+                next_attempt REAL,
+                expires_at REAL
             )''')
             
             await conn.execute('''CREATE TABLE IF NOT EXISTS ads (
@@ -91,6 +266,13 @@ async def init_db():
             )''')
             
             # Add missing columns if needed
+            async with conn.execute("PRAGMA table_info(users)") as cursor:
+                columns = [col[1] for col in await cursor.fetchall()]
+                if 'full_name' not in columns:
+                    await conn.execute("ALTER TABLE users ADD COLUMN full_name TEXT")
+                if 'blocked' not in columns:
+                    await conn.execute("ALTER TABLE users ADD COLUMN blocked INTEGER DEFAULT 0")
+            
             async with conn.execute("PRAGMA table_info(cards)") as cursor:
                 columns = [col[1] for col in await cursor.fetchall()]
                 if 'marked_numbers' not in columns:
@@ -110,231 +292,468 @@ async def init_db():
                     await conn.execute("ALTER TABLE games ADD COLUMN invite_code TEXT DEFAULT ''")
                 if 'is_private' not in columns:
                     await conn.execute("ALTER TABLE games ADD COLUMN is_private INTEGER DEFAULT 0")
+                if 'updated_at' not in columns:
+                    await conn.execute("ALTER TABLE games ADD COLUMN updated_at REAL")
+                    # Legacy live rows get a fresh timestamp so the sweeper expires them after the normal timeout
+                    await conn.execute("UPDATE games SET updated_at = ? WHERE status != 'finished'", (time.time(),))
+                if 'chat_id' not in columns:
+                    await conn.execute("ALTER TABLE games ADD COLUMN chat_id INTEGER")
+            
+            await conn.execute("CREATE INDEX IF NOT EXISTS idx_games_status_updated ON games(status, updated_at)")
+            await conn.execute("CREATE INDEX IF NOT EXISTS idx_games_chat ON games(chat_id)")
+            # Covers per-player card lookups and finding unclaimed pool cards (user_id IS NULL)
+            await conn.execute("CREATE INDEX IF NOT EXISTS idx_cards_user ON cards(user_id)")
+            
+            # Card preferences used to live in PTB's user_data; move them to their own rows
+            async with conn.execute("SELECT key, data FROM persistence WHERE kind = 'user_data'") as cursor:
+                for key, data in await cursor.fetchall():
+                    prefs = {name: value for name, value in pickle.loads(data).items() if name in ('card_mode', 'card_count')}
+                    if prefs:
+                        await conn.execute("INSERT OR REPLACE INTO persistence (kind, key, data) VALUES ('prefs', ?, ?)",
+                                           (key, pickle.dumps(prefs, protocol=pickle.HIGHEST_PROTOCOL)))
+            await conn.execute("DELETE FROM persistence WHERE kind = 'user_data'")
+            # Chat, bot and callback data are not persisted
+            await conn.execute("DELETE FROM persistence WHERE kind IN ('chat_data', 'bot_data', 'callback_data')")
             
+            await conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
             await conn.commit()
         logger.info("Database initialized successfully")
     except Exception as e:
         logger.error(f"Failed to initialize database: {e}")
         raise
 
-async def verify_table(table_name):
-    try:
-        async with aiosqlite.connect(DB_PATH, timeout=10) as conn:
-            async with conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table_name,)) as cursor:
-                result = await cursor.fetchone()
-        return bool(result)
-    except Exception as e:
-        logger.error(f"Error verifying table {table_name}: {e}")
-        return False
+# One writer connection whose transactions queue up in arrival order, plus a pool of read-only connections.
+# In WAL mode a reader sees the last committed state and never waits for the writer's transaction.
+class Database:
+    def __init__(self, path, readers):
+        self._path = path
+        self._size = readers
+        self._readers = asyncio.Queue()
+        self._opened = 0
+        self._writer = None
+        self._write_lock = asyncio.Lock()
+
+    async def _connect(self, read_only):
+        conn = await aiosqlite.connect(self._path, timeout=10, cached_statements=DB_STATEMENT_CACHE)
+        if read_only:
+            # query_only rather than mode=ro: a read-only open fails while no other connection holds the WAL index
+            await conn.execute("PRAGMA query_only = 1")
+        else:
+            await conn.execute("PRAGMA synchronous = NORMAL")
+        return conn
+
+    @contextlib.asynccontextmanager
+    async def read(self):
+        if self._readers.empty() and self._opened < self._size:
+            self._opened += 1
+            try:
+                conn = await self._connect(read_only=True)
+            except Exception:
+                self._opened -= 1
+                raise
+        else:
+            conn = await self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put_nowait(conn)
+
+    @contextlib.asynccontextmanager
+    async def write(self):
+        # Commits when the block exits, rolls back if it raises
+        async with self._write_lock:
+            if self._writer is None:
+                self._writer = await self._connect(read_only=False)
+            try:
+                yield self._writer
+            except BaseException:
+                await self._writer.rollback()
+                raise
+            await self._writer.commit()
+
+    async def close(self):
+        if self._writer is not None:
+            await self._writer.close()
+            self._writer = None
+        while not self._readers.empty():
+            await self._readers.get_nowait().close()
+            self._opened -= 1
+
+db = Database(DB_PATH, DB_READERS)
 
 async def add_ad(file_id, description):
-    async with aiosqlite.connect(DB_PATH) as conn:
+    async with db.write() as conn:
         ad_id = str(uuid.uuid4())
         created_at = time.time()
         await conn.execute("INSERT INTO ads (ad_id, file_id, description, created_at) VALUES (?, ?, ?, ?)",
                  (ad_id, file_id, description, created_at))
-        await conn.commit()
     logger.info(f"Added ad {ad_id} with file_id {file_id}")
     return ad_id
 
 async def delete_ad(ad_id):
-    async with aiosqlite.connect(DB_PATH) as conn:
+    async with db.write() as conn:
         cursor = await conn.execute("DELETE FROM ads WHERE ad_id = ?", (ad_id,))
         affected = cursor.rowcount
-        await conn.commit()
     logger.info(f"Deleted ad {ad_id}")
     return affected > 0
 
+async def update_ad_file_id(ad_id, file_id):
+    async with db.write() as conn:
+        await conn.execute("UPDATE ads SET file_id = ? WHERE ad_id = ?", (file_id, ad_id))
+
 async def get_active_ad():
-    async with aiosqlite.connect(DB_PATH) as conn:
+    async with db.read() as conn:
         async with conn.execute("SELECT ad_id, file_id, description FROM ads ORDER BY created_at DESC LIMIT 1") as cursor:
             ad = await cursor.fetchone()
     return ad
 
 async def create_user(user_id, username):
     try:
-        if not await verify_table('users'):
-            logger.warning("Users table missing, attempting to reinitialize database")
-            await init_db()
-        
-        async with aiosqlite.connect(DB_PATH) as conn:
+        async with db.write() as conn:
             await conn.execute("INSERT OR IGNORE INTO users (user_id, username) VALUES (?, ?)", (user_id, username))
-            await conn.commit()
     except Exception as e:
         logger.error(f"Unexpected error in create_user for user {user_id}: {e}")
         raise
 
+async def save_display_name(user_id, username, full_name):
+    async with db.write() as conn:
+        await conn.execute("INSERT INTO users (user_id, username, full_name) VALUES (?, ?, ?) "
+                 "ON CONFLICT(user_id) DO UPDATE SET full_name = excluded.full_name", (user_id, username, full_name))
+
+async def get_display_name(user_id):
+    async with db.read() as conn:
+        async with conn.execute("SELECT full_name, username FROM users WHERE user_id = ?", (user_id,)) as cursor:
+            row = await cursor.fetchone()
+    if not row:
+        return None
+    return row[0] or row[1]
+
+async def set_user_blocked(user_id, blocked):
+    async with db.write() as conn:
+        await conn.execute("UPDATE users SET blocked = ? WHERE user_id = ?", (1 if blocked else 0, user_id))
+
+async def get_blocked_users():
+    async with db.read() as conn:
+        async with conn.execute("SELECT user_id FROM users WHERE blocked = 1") as cursor:
+            rows = await cursor.fetchall()
+    return {user_id for (user_id,) in rows}
+
 async def get_user_cards(user_id):
-    async with aiosqlite.connect(DB_PATH) as conn:
-        async with conn.execute("SELECT card_id, numbers, marked_numbers, positions, marked_time FROM cards WHERE user_id = ?", (user_id,)) as cursor:
-            cards = await cursor.fetchall()
+    async with db.read() as conn:
+        async with conn.execute("SELECT card_id, numbers, marked_numbers, positions, marked_time FROM cards WHERE user_id = ? ORDER BY ROWID", (user_id,)) as cursor:
+            rows = await cursor.fetchall()
+    cards = []
+    for card_id, numbers, marked_numbers, positions, marked_time in rows:
+        marked_numbers, marked_time = PENDING_MARKS.get(card_id, (marked_numbers, marked_time))
+        cards.append((card_id, numbers, marked_numbers, positions, marked_time))
+    return cards
+
+async def get_cards_for_users(user_ids):
+    user_ids = [int(uid) for uid in user_ids if uid]
+    cards = {uid: [] for uid in user_ids}
+    if not user_ids:
+        return cards
+    async with db.read() as conn:
+        placeholders = ','.join('?' * len(user_ids))
+        async with conn.execute(f"SELECT user_id, card_id, numbers, marked_numbers, positions, marked_time FROM cards WHERE user_id IN ({placeholders}) ORDER BY ROWID", user_ids) as cursor:
+            async for user_id, card_id, numbers, marked_numbers, positions, marked_time in cursor:
+                marked_numbers, marked_time = PENDING_MARKS.get(card_id, (marked_numbers, marked_time))
+                cards[user_id].append((card_id, numbers, marked_numbers, positions, marked_time))
     return cards
 
+async def insert_cards(rows):
+    # rows are (card_id, user_id, numbers, positions); a None user_id puts the card in the pool
+    async with db.write() as conn:
+        await conn.executemany("INSERT INTO cards (card_id, user_id, numbers, positions) VALUES (?, ?, ?, ?)", rows)
+
+async def delete_cards_for_users(user_ids):
+    # One prepared statement and one commit for the whole game, whatever the player count
+    async with db.write() as conn:
+        await conn.executemany("DELETE FROM cards WHERE user_id = ?", [(int(uid),) for uid in user_ids if uid])
+
 async def delete_user_cards(user_id):
-    async with aiosqlite.connect(DB_PATH) as conn:
-        await conn.execute("DELETE FROM cards WHERE user_id = ?", (user_id,))
-        await conn.commit()
+    await delete_cards_for_users([user_id])
 
 async def delete_all_cards():
-    async with aiosqlite.connect(DB_PATH) as conn:
+    async with db.write() as conn:
         await conn.execute("DELETE FROM cards")
-        await conn.commit()
 
-async def generate_card(user_id):
-    async with aiosqlite.connect(DB_PATH) as conn:
-        card_id = str(uuid.uuid4())
-        
-        ranges = [
-            (1, 9), (10, 19), (20, 29), (30, 39),
-            (40, 49), (50, 59), (60, 69), (70, 80)
-        ]
-        
-        numbers_per_column = [0] * 8
-        total_numbers = 0
-        
-        while total_numbers < 15:
-            for col_idx in range(8):
-                if total_numbers >= 15:
-                    break
-                if numbers_per_column[col_idx] >= 3:
-                    continue
-                if random.random() < 0.5:
-                    numbers_per_column[col_idx] += 1
-                    total_numbers += 1
-        
-        while total_numbers < 15:
-            available_columns = [i for i, count in enumerate(numbers_per_column) if count < 3]
-            if not available_columns:
+def build_card_layout():
+    ranges = [
+        (1, 9), (10, 19), (20, 29), (30, 39),
+        (40, 49), (50, 59), (60, 69), (70, 80)
+    ]
+    
+    numbers_per_column = [0] * 8
+    total_numbers = 0
+    
+    while total_numbers < 15:
+        for col_idx in range(8):
+            if total_numbers >= 15:
                 break
-            col_idx = random.choice(available_columns)
-            numbers_per_column[col_idx] += 1
-            total_numbers += 1
-        
-        numbers = []
-        for col_idx, (start, end) in enumerate(ranges):
-            col_numbers = random.sample(range(start, end + 1), numbers_per_column[col_idx])
-            numbers.extend(col_numbers)
-        
-        numbers.sort()
-        
-        columns = [[] for _ in range(8)]
-        for num in numbers:
-            num_int = int(num)
-            col = min((num_int - 1) // 10, 7) if num_int < 70 else 7
-            columns[col].append(str(num))
-        
-        positions = []
-        for col_idx, col_nums in enumerate(columns):
-            if not col_nums:
+            if numbers_per_column[col_idx] >= 3:
                 continue
-            available_rows = list(range(3))
-            random.shuffle(available_rows)
-            for i, num in enumerate(col_nums):
-                if i >= len(available_rows):
-                    continue
-                row = available_rows[i]
-                positions.append(f"{num}:{row}")
-        
-        numbers_str = ','.join(map(str, numbers))
-        positions_str = ','.join(positions)
-        
-        if len(numbers) != 15:
-            return None
-        
-        await conn.execute("INSERT INTO cards (card_id, user_id, numbers, positions) VALUES (?, ?, ?, ?)",
-                 (card_id, user_id, numbers_str, positions_str))
-        await conn.commit()
-    return card_id
+            if random.random() < 0.5:
+                numbers_per_column[col_idx] += 1
+                total_numbers += 1
+    
+    while total_numbers < 15:
+        available_columns = [i for i, count in enumerate(numbers_per_column) if count < 3]
+        if not available_columns:
+            break
+        col_idx = random.choice(available_columns)
+        numbers_per_column[col_idx] += 1
+        total_numbers += 1
+    
+    numbers = []
+    for col_idx, (start, end) in enumerate(ranges):
+        col_numbers = random.sample(range(start, end + 1), numbers_per_column[col_idx])
+        numbers.extend(col_numbers)
+    
+    numbers.sort()
+    
+    columns = [[] for _ in range(8)]
+    for num in numbers:
+        num_int = int(num)
+        col = min((num_int - 1) // 10, 7) if num_int < 70 else 7
+        columns[col].append(str(num))
+    
+    positions = []
+    for col_idx, col_nums in enumerate(columns):
+        if not col_nums:
+            continue
+        available_rows = list(range(3))
+        random.shuffle(available_rows)
+        for i, num in enumerate(col_nums):
+            if i >= len(available_rows):
+                continue
+            row = available_rows[i]
+            positions.append(f"{num}:{row}")
+    
+    numbers_str = ','.join(map(str, numbers))
+    positions_str = ','.join(positions)
+    
+    if len(numbers) != 15:
+        return None
+    return numbers_str, positions_str
 
-async def create_game(invite_code, is_private=False):
-    async with aiosqlite.connect(DB_PATH) as conn:
+async def claim_pool_cards(user_id, count):
+    # Unclaimed pool cards have no owner; a single UPDATE hands a batch over atomically
+    async with db.write() as conn:
+        async with conn.execute("UPDATE cards SET user_id = ? WHERE card_id IN (SELECT card_id FROM cards WHERE user_id IS NULL LIMIT ?) RETURNING card_id",
+                 (user_id, count)) as cursor:
+            rows = await cursor.fetchall()
+    return [card_id for (card_id,) in rows]
+
+async def generate_cards(user_id, count=1):
+    try:
+        card_ids = await claim_pool_cards(user_id, count)
+    except Exception as e:
+        logger.warning(f"Failed to claim pooled cards for user {user_id}: {e}")
+        card_ids = []
+    METRICS['card_pool_claims'] += len(card_ids)
+    if len(card_ids) >= count:
+        return card_ids
+
+    METRICS['card_pool_misses'] += count - len(card_ids)
+    rows = []
+    for _ in range(count - len(card_ids)):
+        layout = build_card_layout()
+        if layout is not None:
+            rows.append((str(uuid.uuid4()), user_id, *layout))
+    await insert_cards(rows)
+    return card_ids + [row[0] for row in rows]
+
+async def count_pool_cards():
+    async with db.read() as conn:
+        async with conn.execute("SELECT COUNT(*) FROM cards WHERE user_id IS NULL") as cursor:
+            (count,) = await cursor.fetchone()
+    return count
+
+async def add_pool_cards(count):
+    rows = []
+    while len(rows) < count:
+        layout = build_card_layout()
+        if layout is not None:
+            rows.append((str(uuid.uuid4()), None, *layout))
+    await insert_cards(rows)
+
+async def create_game(invite_code, is_private=False, chat_id=None):
+    async with db.write() as conn:
         game_id = str(uuid.uuid4())
-        await conn.execute("INSERT INTO games (game_id, status, players, drawn_numbers, start_time, waiting_players, invite_code, is_private) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-                 (game_id, 'waiting', '', '', None, '', invite_code, 1 if is_private else 0))
-        await conn.commit()
+        await conn.execute("INSERT INTO games (game_id, status, players, drawn_numbers, start_time, waiting_players, invite_code, is_private, updated_at, chat_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                 (game_id, 'waiting', '', '', None, '', invite_code, 1 if is_private else 0, time.time(), chat_id))
+    invalidate_games(game_id)
     return game_id
 
 async def update_game_status(game_id, status, players=None, current_number=None, last_message_id=None, drawn_numbers=None, start_time=None, waiting_players=None):
-    async with aiosqlite.connect(DB_PATH) as conn:
+    async with db.write() as conn:
         # Check current status first to prevent overwriting 'finished'
         async with conn.execute("SELECT status FROM games WHERE game_id = ?", (game_id,)) as cursor:
             row = await cursor.fetchone()
             if row and row[0] == 'finished' and status != 'finished':
                 return
 
+        updated_at = time.time()
         if players is not None:
             if waiting_players is not None:
-                await conn.execute("UPDATE games SET status = ?, players = ?, start_time = ?, waiting_players = ? WHERE game_id = ?",
-                         (status, players, start_time, waiting_players, game_id))
+                await conn.execute("UPDATE games SET status = ?, players = ?, start_time = ?, waiting_players = ?, updated_at = ? WHERE game_id = ?",
+                         (status, players, start_time, waiting_players, updated_at, game_id))
             else:
-                await conn.execute("UPDATE games SET status = ?, players = ?, start_time = ? WHERE game_id = ?",
-                         (status, players, start_time, game_id))
+                await conn.execute("UPDATE games SET status = ?, players = ?, start_time = ?, updated_at = ? WHERE game_id = ?",
+                         (status, players, start_time, updated_at, game_id))
         elif current_number is not None:
-            await conn.execute("UPDATE games SET status = ?, current_number = ?, last_message_id = ?, drawn_numbers = ? WHERE game_id = ?",
-                     (status, current_number, last_message_id, drawn_numbers, game_id))
+            await conn.execute("UPDATE games SET status = ?, current_number = ?, last_message_id = ?, drawn_numbers = ?, updated_at = ? WHERE game_id = ?",
+                     (status, current_number, last_message_id, drawn_numbers, updated_at, game_id))
         else:
             if waiting_players is not None:
-                await conn.execute("UPDATE games SET status = ?, waiting_players = ? WHERE game_id = ?",
-                         (status, waiting_players, game_id))
+                await conn.execute("UPDATE games SET status = ?, waiting_players = ?, updated_at = ? WHERE game_id = ?",
+                         (status, waiting_players, updated_at, game_id))
             else:
-                await conn.execute("UPDATE games SET status = ? WHERE game_id = ?", (status, game_id))
-        await conn.commit()
+                await conn.execute("UPDATE games SET status = ?, updated_at = ? WHERE game_id = ?", (status, updated_at, game_id))
+    invalidate_games(game_id)
+
+async def finish_game(game_id):
+    # Atomic transition so concurrent winners, exits and draw loops finish a game exactly once
+    async with db.write() as conn:
+        cursor = await conn.execute("UPDATE games SET status = 'finished', updated_at = ? WHERE game_id = ? AND status != 'finished'",
+                 (time.time(), game_id))
+        finished = cursor.rowcount > 0
+    invalidate_games(game_id)
+    return finished
+
+@contextlib.asynccontextmanager
+async def membership_lock(key):
+    # Joins and leaves of one game run one at a time, other games are not held up
+    entry = _membership_locks.setdefault(key, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del _membership_locks[key]
+
+async def add_waiting_player(game_id, user_id):
+    async with membership_lock(game_id):
+        game = await get_game_by_id(game_id)
+        if not game:
+            return
+        waiting_ids = game[5].split(',') if game[5] else []
+        if str(user_id) not in waiting_ids:
+            waiting_ids.append(str(user_id))
+            await update_game_status(game_id, game[1], waiting_players=','.join(waiting_ids))
+
+async def get_or_create_public_game():
+    game = await get_current_public_game()
+    if game:
+        return game[0]
+    # Only creating the public game is serialized across all users, so two joins cannot open two lobbies
+    async with membership_lock('public'):
+        game = await get_current_public_game()
+        if game:
+            return game[0]
+        return await create_game(str(uuid.uuid4())[:8], is_private=False)
 
 async def get_current_public_game():
-    async with aiosqlite.connect(DB_PATH) as conn:
-        async with conn.execute("SELECT game_id, status, players, drawn_numbers, start_time, waiting_players, invite_code, is_private FROM games WHERE status != 'finished' AND is_private = 0 ORDER BY ROWID DESC LIMIT 1") as cursor:
+    async with db.read() as conn:
+        async with conn.execute(f"SELECT game_id, status, players, drawn_numbers, start_time, waiting_players, invite_code, is_private FROM games WHERE status IN ({LIVE_STATUS_SQL}) AND is_private = 0 ORDER BY ROWID DESC LIMIT 1") as cursor:
             game = await cursor.fetchone()
     return game
 
 async def get_game_by_invite_code(invite_code):
-    async with aiosqlite.connect(DB_PATH) as conn:
-        async with conn.execute("SELECT game_id, status, players, drawn_numbers, start_time, waiting_players, invite_code, is_private FROM games WHERE invite_code = ? AND status != 'finished'", (invite_code,)) as cursor:
+    async with db.read() as conn:
+        async with conn.execute(f"SELECT game_id, status, players, drawn_numbers, start_time, waiting_players, invite_code, is_private FROM games WHERE invite_code = ? AND status IN ({LIVE_STATUS_SQL})", (invite_code,)) as cursor:
             game = await cursor.fetchone()
     return game
 
-async def mark_number(card_id, number):
-    async with aiosqlite.connect(DB_PATH) as conn:
-        async with conn.execute("SELECT marked_numbers, numbers FROM cards WHERE card_id = ?", (card_id,)) as cursor:
-            result = await cursor.fetchone()
-        
-        if not result:
-            return False
-        
-        marked_numbers, numbers = result
-        numbers_list = numbers.split(',') if numbers else []
-        number_str = str(number).strip()
-        
-        if number_str in numbers_list:
-            marked = marked_numbers.split(',') if marked_numbers else []
-            if number_str not in marked:
-                marked.append(number_str)
-                marked_str = ','.join(marked)
-                current_time = time.time()
-                await conn.execute("UPDATE cards SET marked_numbers = ?, marked_time = ? WHERE card_id = ?",
-                         (marked_str, current_time, card_id))
-                await conn.commit()
-                return True
-            else:
-                return False
-        else:
-            return False
+async def mark_cards(card_ids, numbers):
+    # Marks the numbers on every given card that holds them and returns the (card_id, number) pairs that changed.
+    # Nothing is written here: the caller journals the marks and the snapshot job folds them into the cards table.
+    numbers_str = [str(number).strip() for number in numbers]
+    async with db.read() as conn:
+        placeholders = ','.join('?' * len(card_ids))
+        async with conn.execute(f"SELECT card_id, marked_numbers, numbers FROM cards WHERE card_id IN ({placeholders})", card_ids) as cursor:
+            results = await cursor.fetchall()
+    
+    changed = []
+    current_time = time.time()
+    for card_id, marked_numbers, card_numbers in results:
+        marked_numbers, _ = PENDING_MARKS.get(card_id, (marked_numbers, None))
+        numbers_list = card_numbers.split(',') if card_numbers else []
+        marked = marked_numbers.split(',') if marked_numbers else []
+        new = [num for num in numbers_str if num in numbers_list and num not in marked]
+        if new:
+            marked.extend(new)
+            PENDING_MARKS[card_id] = (','.join(marked), current_time)
+            changed.extend((card_id, num) for num in new)
+    return changed
+
+async def fold_pending_marks():
+    if not PENDING_MARKS:
+        return
+    pending = dict(PENDING_MARKS)
+    async with db.write() as conn:
+        await conn.executemany("UPDATE cards SET marked_numbers = ?, marked_time = ? WHERE card_id = ?",
+                 [(marked_numbers, marked_time, card_id) for card_id, (marked_numbers, marked_time) in pending.items()])
+    for card_id, marks in pending.items():
+        # A card marked again while the batch was written keeps its newer entry for the next fold
+        if PENDING_MARKS.get(card_id) is marks:
+            del PENDING_MARKS[card_id]
+
+def get_draw_positions(order):
+    positions = [0] * (MAX_NUMBER + 1)
+    for index, num in enumerate(order):
+        positions[int(num)] = index
+    return positions
+
+def card_completion_index(numbers, draw_positions):
+    # Draw index after which every number of the card is out, i.e. the earliest it can win
+    return max(draw_positions[int(num)] for num in numbers)
+
+async def index_card_completions(game_id, player_ids):
+    state = LIVE_GAMES[game_id]
+    positions = get_draw_positions(state['drawn'] + state['remaining'])
+    async with db.read() as conn:
+        placeholders = ','.join('?' * len(player_ids))
+        async with conn.execute(f"SELECT card_id, numbers FROM cards WHERE user_id IN ({placeholders})", player_ids) as cursor:
+            cards = await cursor.fetchall()
+    completions = sorted((card_completion_index(numbers.split(','), positions), card_id) for card_id, numbers in cards if numbers)
+    state['completion_keys'] = [index for index, _ in completions]
+    state['completion_cards'] = [card_id for _, card_id in completions]
 
 async def check_all_winners(context: ContextTypes.DEFAULT_TYPE, game_id):
-    current_game = await get_game_by_id(game_id)
-    if not current_game:
-        return None, None
+    state = LIVE_GAMES.get(game_id)
+    if state is not None and 'completion_keys' in state:
+        # Only cards whose last number is already drawn can be fully marked
+        ready = bisect.bisect_right(state['completion_keys'], len(state['drawn']) - 1)
+        if not ready:
+            return None, None
+        card_ids = state['completion_cards'][:ready]
+        async with db.read() as conn:
+            placeholders = ','.join('?' * len(card_ids))
+            query = f"SELECT user_id, card_id, numbers, marked_numbers, marked_time FROM cards WHERE card_id IN ({placeholders})"
+            async with conn.execute(query, card_ids) as cursor:
+                all_cards = await cursor.fetchall()
+    else:
+        current_game = await get_game_by_id(game_id)
+        if not current_game:
+            return None, None
+        
+        player_ids = current_game[2].split(',')
+        
+        # Optimize: Fetch all cards for all players in one query
+        async with db.read() as conn:
+            placeholders = ','.join('?' * len(player_ids))
+            query = f"SELECT user_id, card_id, numbers, marked_numbers, marked_time FROM cards WHERE user_id IN ({placeholders})"
+            async with conn.execute(query, player_ids) as cursor:
+                all_cards = await cursor.fetchall()
     
-    player_ids = current_game[2].split(',')
     potential_winners = []
-    
-    # Optimize: Fetch all cards for all players in one query
-    async with aiosqlite.connect(DB_PATH) as conn:
-        placeholders = ','.join('?' * len(player_ids))
-        query = f"SELECT user_id, card_id, numbers, marked_numbers, marked_time FROM cards WHERE user_id IN ({placeholders})"
-        async with conn.execute(query, player_ids) as cursor:
-            all_cards = await cursor.fetchall()
             
     for user_id, card_id, numbers, marked_numbers, marked_time in all_cards:
+        marked_numbers, marked_time = PENDING_MARKS.get(card_id, (marked_numbers, marked_time))
         if not marked_numbers or not numbers:
             continue
         marked = marked_numbers.split(',') if marked_numbers else []
@@ -351,19 +770,141 @@ async def check_all_winners(context: ContextTypes.DEFAULT_TYPE, game_id):
     winner_id, winner_card_id, _ = potential_winners[0]
     return winner_id, winner_card_id
 
+# Bumped on every invalidation so a read that raced with a write does not cache the old row
+_game_cache_generation = 0
+
+def invalidate_games(*game_ids):
+    global _game_cache_generation
+    _game_cache_generation += 1
+    for game_id in game_ids:
+        game_cache.pop(game_id)
+
 async def get_game_by_id(game_id):
-    async with aiosqlite.connect(DB_PATH) as conn:
-        async with conn.execute("SELECT game_id, status, players, drawn_numbers, start_time, waiting_players, invite_code, is_private FROM games WHERE game_id = ? AND status != 'finished'", (game_id,)) as cursor:
+    game = game_cache.get(game_id)
+    if game is not None:
+        METRICS['game_cache_hits'] += 1
+        return game
+    METRICS['game_cache_misses'] += 1
+    generation = _game_cache_generation
+    async with db.read() as conn:
+        async with conn.execute(f"SELECT game_id, status, players, drawn_numbers, start_time, waiting_players, invite_code, is_private FROM games WHERE game_id = ? AND status IN ({LIVE_STATUS_SQL})", (game_id,)) as cursor:
+            game = await cursor.fetchone()
+    if game is not None and generation == _game_cache_generation:
+        game_cache.set(game_id, game)
+    return game
+
+async def get_game_by_chat(chat_id):
+    async with db.read() as conn:
+        async with conn.execute(f"SELECT game_id, status, players, drawn_numbers, start_time, waiting_players, invite_code, is_private FROM games WHERE chat_id = ? AND status IN ({LIVE_STATUS_SQL}) LIMIT 1", (chat_id,)) as cursor:
             game = await cursor.fetchone()
     return game
 
+async def get_game_chat_id(game_id):
+    async with db.read() as conn:
+        async with conn.execute("SELECT chat_id FROM games WHERE game_id = ?", (game_id,)) as cursor:
+            row = await cursor.fetchone()
+    return row[0] if row else None
+
 async def get_game_by_id_for_user(user_id):
-    async with aiosqlite.connect(DB_PATH) as conn:
-        async with conn.execute("SELECT game_id, status, players, drawn_numbers, start_time, waiting_players, invite_code, is_private FROM games WHERE status != 'finished' AND (players LIKE ? OR waiting_players LIKE ?) LIMIT 1",
+    async with db.read() as conn:
+        async with conn.execute(f"SELECT game_id, status, players, drawn_numbers, start_time, waiting_players, invite_code, is_private FROM games WHERE status IN ({LIVE_STATUS_SQL}) AND (players LIKE ? OR waiting_players LIKE ?) LIMIT 1",
                  (f'%{user_id}%', f'%{user_id}%')) as cursor:
             game = await cursor.fetchone()
     return game
 
+async def expire_stale_games():
+    now = time.time()
+    cutoffs = (
+        ('waiting', now - STALE_WAITING_TIMEOUT),
+        ('preparing', now - STALE_WAITING_TIMEOUT),
+        ('running', now - STALE_RUNNING_TIMEOUT),
+    )
+    async with db.write() as conn:
+        stale = []
+        for status, cutoff in cutoffs:
+            remaining = STALE_SWEEP_BATCH - len(stale)
+            if remaining <= 0:
+                break
+            async with conn.execute("SELECT game_id, players, waiting_players FROM games WHERE status = ? AND updated_at < ? LIMIT ?",
+                     (status, cutoff, remaining)) as cursor:
+                stale.extend(await cursor.fetchall())
+        if not stale:
+            return []
+
+        game_ids = [game_id for game_id, _, _ in stale]
+        placeholders = ','.join('?' * len(game_ids))
+        await conn.execute(f"UPDATE games SET status = 'finished', updated_at = ? WHERE game_id IN ({placeholders})", (now, *game_ids))
+
+        # Only drop cards of players who are not already sitting in another live game
+        stale_players = {pid for _, players, _ in stale for pid in (players or '').split(',') if pid}
+        if stale_players:
+            async with conn.execute(f"SELECT players FROM games WHERE status IN ({LIVE_STATUS_SQL})") as cursor:
+                live_players = {pid for (players,) in await cursor.fetchall() for pid in (players or '').split(',') if pid}
+            orphaned = list(stale_players - live_players)
+            if orphaned:
+                await conn.executemany("DELETE FROM cards WHERE user_id = ?", [(int(pid),) for pid in orphaned])
+        placeholders = ','.join('?' * len(game_ids))
+        await conn.execute(f"DELETE FROM game_snapshots WHERE game_id IN ({placeholders})", game_ids)
+    invalidate_games(*game_ids)
+    for game_id in game_ids:
+        _saved_snapshots.pop(game_id, None)
+    return game_ids
+
+_saved_snapshots = {}
+
+async def save_game_snapshots(snapshots):
+    rows = []
+    progress = []
+    for game_id, data in snapshots.items():
+        encoded = json.dumps(data, separators=(',', ':'))
+        if _saved_snapshots.get(game_id) != encoded:
+            rows.append((game_id, encoded, time.time()))
+            if data.get('drawn'):
+                # Draws only go to the journal, so the games row is brought up to date here
+                progress.append((int(data['drawn'][-1]), ','.join(data['drawn']), time.time(), game_id))
+    if not rows:
+        return
+    async with db.write() as conn:
+        await conn.executemany("INSERT OR REPLACE INTO game_snapshots (game_id, data, updated_at) VALUES (?, ?, ?)", rows)
+        if progress:
+            await conn.executemany("UPDATE games SET current_number = ?, drawn_numbers = ?, updated_at = ? WHERE game_id = ? AND status = 'running'", progress)
+    invalidate_games(*(game_id for *_, game_id in progress))
+    for game_id, encoded, _ in rows:
+        _saved_snapshots[game_id] = encoded
+
+async def delete_game_snapshot(game_id):
+    _saved_snapshots.pop(game_id, None)
+    async with db.write() as conn:
+        await conn.execute("DELETE FROM game_snapshots WHERE game_id = ?", (game_id,))
+
+async def load_outbox():
+    async with db.read() as conn:
+        async with conn.execute("SELECT key, chat_id, text, parse_mode, reply_markup, attempts, next_attempt, expires_at FROM outbox ORDER BY next_attempt") as cursor:
+            return await cursor.fetchall()
+
+async def save_outbox(rows, deleted_keys):
+    async with db.write() as conn:
+        if rows:
+            await conn.executemany("INSERT OR REPLACE INTO outbox (key, chat_id, text, parse_mode, reply_markup, attempts, next_attempt, expires_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        if deleted_keys:
+            await conn.executemany("DELETE FROM outbox WHERE key = ?", [(key,) for key in deleted_keys])
+
+async def get_webhook_fingerprint():
+    async with db.read() as conn:
+        async with conn.execute("SELECT data FROM persistence WHERE kind = 'webhook' AND key = 'fingerprint'") as cursor:
+            row = await cursor.fetchone()
+    return row[0] if row else None
+
+async def save_webhook_fingerprint(fingerprint):
+    async with db.write() as conn:
+        await conn.execute("INSERT OR REPLACE INTO persistence (kind, key, data) VALUES ('webhook', 'fingerprint', ?)", (fingerprint,))
+
+async def get_resumable_games():
+    async with db.read() as conn:
+        async with conn.execute("SELECT g.game_id, g.status, g.players, g.drawn_numbers, g.start_time, g.is_private, s.data FROM games g LEFT JOIN game_snapshots s ON s.game_id = g.game_id WHERE g.status IN ('preparing', 'running')") as cursor:
+            rows = await cursor.fetchall()
+    return [(*row[:6], json.loads(row[6]) if row[6] else None) for row in rows]
+
 def get_main_menu():
     keyboard = [
         ["🎮 Խաղալ", "🎉 Խաղալ ընկերների հետ"],
@@ -415,7 +956,20 @@ def build_card_grid(card_id, numbers, marked_numbers, positions):
     
     return grid, marked
 
-def get_card_keyboard(card_id, numbers, marked_numbers, game_id, positions):
+def get_card_keyboard(cards, game_id):
+    keyboard = []
+    for card_id, numbers, marked_numbers, positions in cards:
+        rows = get_card_rows(card_id, numbers, marked_numbers, game_id, positions)
+        if rows is None:
+            return None
+        if len(cards) > 1:
+            keyboard.append([InlineKeyboardButton(f"📜 {card_id[-8:]}", callback_data='noop')])
+        keyboard.extend(rows)
+    keyboard.append([InlineKeyboardButton("🏃 Դուրս գալ", callback_data='exit')])
+    
+    return InlineKeyboardMarkup(keyboard)
+
+def get_card_rows(card_id, numbers, marked_numbers, game_id, positions):
     grid, marked = build_card_grid(card_id, numbers, marked_numbers, positions)
     if grid is None:
         return None
@@ -434,60 +988,687 @@ def get_card_keyboard(card_id, numbers, marked_numbers, game_id, positions):
                 callback_data = f'mark_{short_game_id}_{short_card_id}_{num}'
                 row_buttons.append(InlineKeyboardButton(text, callback_data=callback_data))
         keyboard.append(row_buttons)
-    keyboard.append([InlineKeyboardButton("🏃 Դուրս գալ", callback_data='exit')])
     
+    return keyboard
+
+def get_compact_card_keyboard(target, game_id):
+    # target is a short card id or 'all' for every card of the message; the pad is for numbers missed earlier
+    keyboard = [
+        [InlineKeyboardButton("✅ Նշել վերջին թիվը", callback_data=f'last_{game_id[-8:]}_{target}')],
+        [InlineKeyboardButton("🔢 Նշել այլ թիվ", callback_data=f'pad_{game_id[-8:]}_{target}_')],
+        [InlineKeyboardButton("🏃 Դուրս գալ", callback_data='exit')]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+def get_number_pad_keyboard(target, game_id, entered):
+    # Digits are typed one tap at a time; a full number starts over with the next digit
+    prefix = f'pad_{game_id[-8:]}_{target}_'
+    max_digits = len(str(MAX_NUMBER))
+    def digit(d):
+        typed = entered + str(d) if len(entered) < max_digits else str(d)
+        return InlineKeyboardButton(str(d), callback_data=prefix + typed)
+    keyboard = [[digit(d) for d in row] for row in ((1, 2, 3), (4, 5, 6), (7, 8, 9))]
+    confirm = (InlineKeyboardButton(f"✅ {int(entered)}", callback_data=f'mark_{game_id[-8:]}_{target}_{int(entered)}')
+               if entered else InlineKeyboardButton("✅", callback_data=prefix))
+    keyboard.append([InlineKeyboardButton("↩️", callback_data=prefix + 'back'), digit(0), confirm])
     return InlineKeyboardMarkup(keyboard)
 
+def build_card_template(card_id, numbers, positions):
+    grid, _ = build_card_grid(card_id, numbers, '', positions)
+    lines = []
+    cells = []
+    for row in grid:
+        parts = []
+        for num in row:
+            if num is None:
+                parts.append('  ')
+            else:
+                parts.append('{}')
+                cells.append(num)
+        lines.append(' '.join(parts))
+    text = f"📜 Ձեր քարտը (ID: {card_id[-8:]}):\n```\n" + '\n'.join(lines) + "\n```"
+    return text, cells
+
+def render_card_text(card_id, numbers, marked_numbers, positions):
+    # The layout of a card never changes, so only the marks are filled into a cached template
+    template = card_templates.get(card_id)
+    if template is None:
+        template = build_card_template(card_id, numbers, positions)
+        card_templates.set(card_id, template)
+    text, cells = template
+    marked = set(marked_numbers.split(',')) if marked_numbers else set()
+    return text.format(*(CARD_MARK if num in marked else f"{num:>2}" for num in cells))
+
+async def get_user_prefs(user_id):
+    # Preferences are cached in a bounded store and read back from their persistence row after eviction
+    prefs = user_prefs.get(int(user_id))
+    if prefs is None:
+        async with db.read() as conn:
+            async with conn.execute("SELECT data FROM persistence WHERE kind = 'prefs' AND key = ?", (str(user_id),)) as cursor:
+                row = await cursor.fetchone()
+        prefs = pickle.loads(row[0]) if row else {}
+        user_prefs.set(int(user_id), prefs)
+    return prefs
+
+async def set_user_pref(user_id, name, value):
+    prefs = {**await get_user_prefs(user_id), name: value}
+    async with db.write() as conn:
+        await conn.execute("INSERT OR REPLACE INTO persistence (kind, key, data) VALUES ('prefs', ?, ?)",
+                           (str(user_id), pickle.dumps(prefs, protocol=pickle.HIGHEST_PROTOCOL)))
+    user_prefs.set(int(user_id), prefs)
+
+async def get_card_mode(user_id):
+    return (await get_user_prefs(user_id)).get('card_mode', CARD_RENDER_MODE)
+
+async def get_card_count(user_id):
+    return (await get_user_prefs(user_id)).get('card_count', CARDS_PER_PLAYER)
+
+def cards_given_text(count):
+    return "📜 Ձեզ տրվեց մեկ քարտ։" if count == 1 else f"📜 Ձեզ տրվեց {count} քարտ։"
+
+def group_cards(mode, cards):
+    # Text cards are small enough to share one message; keyboards are bounded by the button limit
+    size = MAX_CARDS_PER_PLAYER if mode == 'text' else CARDS_PER_MESSAGE
+    return [cards[i:i + size] for i in range(0, len(cards), size)]
+
+def render_card_message(mode, cards, game_id):
+    # cards: (card_id, numbers, marked_numbers, positions) rows rendered into one message
+    if any(len(numbers.split(',')) != 15 for _, numbers, _, _ in cards):
+        return None
+    card_ids = [card_id for card_id, _, _, _ in cards]
+    if mode == 'text':
+        text = '\n\n'.join(render_card_text(*card) for card in cards)
+        target = card_ids[0][-8:] if len(card_ids) == 1 else 'all'
+        return text, get_compact_card_keyboard(target, game_id), ParseMode.MARKDOWN
+    keyboard = get_card_keyboard(cards, game_id)
+    if keyboard is None:
+        return None
+    if len(card_ids) == 1:
+        return f"📜 Ձեր քարտը (ID: {card_ids[0][-8:]}):", keyboard, None
+    return f"📜 Ձեր քարտերը (ID: {', '.join(card_id[-8:] for card_id in card_ids)}):", keyboard, None
+
+# LRU store with idle expiry for per-user and per-game ephemeral data
+class BoundedStore:
+    def __init__(self, max_entries, ttl, track_dirty=False):
+        self._entries = OrderedDict()
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._dirty = set() if track_dirty else None
+
+    def mark_dirty(self, key):
+        if self._dirty is not None:
+            self._dirty.add(key)
+
+    def take_dirty(self):
+        dirty, self._dirty = self._dirty, set()
+        return dirty
+
+    def _evict(self):
+        cutoff = time.monotonic() - self._ttl
+        while self._entries:
+            key, (touched, _) = next(iter(self._entries.items()))
+            if touched >= cutoff and len(self._entries) <= self._max_entries:
+                break
+            del self._entries[key]
+            self.mark_dirty(key)
+
+    def expire(self):
+        # Entries also expire without inserts: on every lookup and on the periodic sweep
+        self._evict()
+
+    def get(self, key, default=None):
+        self._evict()
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        self._entries[key] = (time.monotonic(), entry[1])
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def setdefault(self, key, factory):
+        value = self.get(key)
+        if value is None:
+            value = factory()
+            self._entries[key] = (time.monotonic(), value)
+            self._evict()
+        return value
+
+    def set(self, key, value):
+        self._entries[key] = (time.monotonic(), value)
+        self._entries.move_to_end(key)
+        self._evict()
+
+    def peek(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic() - self._ttl:
+            return default
+        return entry[1]
+
+    def pop(self, key, default=None):
+        entry = self._entries.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def items(self):
+        return [(key, value) for key, (_, value) in self._entries.items()]
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def memory_usage(self):
+        def size(obj):
+            total = sys.getsizeof(obj)
+            if isinstance(obj, dict):
+                total += sum(size(k) + size(v) for k, v in obj.items())
+            elif isinstance(obj, (list, tuple, set, deque)):
+                total += sum(size(item) for item in obj)
+            return total
+        # Measured on a sample and scaled up, so a scrape does not walk every entry
+        sample = list(itertools.islice(self._entries.items(), STATE_SIZE_SAMPLE))
+        if not sample:
+            return sys.getsizeof(self._entries)
+        sampled = sum(size(key) + size(entry) for key, entry in sample)
+        return sys.getsizeof(self._entries) + sampled * len(self._entries) // len(sample)
+
+def new_user_state():
+    return {'cleanup_msgs': deque(maxlen=MAX_TRACKED_MESSAGES)}
+
+def new_game_state():
+    return {'countdown_message_ids': {}}
+
+user_state = BoundedStore(USER_STATE_MAX, USER_STATE_TTL, track_dirty=True)
+game_state = BoundedStore(GAME_STATE_MAX, GAME_STATE_TTL)
+display_names = BoundedStore(USER_STATE_MAX, USER_STATE_TTL)
+user_prefs = BoundedStore(USER_STATE_MAX, USER_STATE_TTL)
+card_templates = BoundedStore(GAME_STATE_MAX, GAME_STATE_TTL)
+game_cache = BoundedStore(GAME_CACHE_MAX, GAME_CACHE_TTL)
+
 def track_message(context: ContextTypes.DEFAULT_TYPE, user_id: int, message_id: int):
     try:
-        # Safely get or create user_data
-        if context.user_data is not None and getattr(context, '_user_id', None) == user_id:
-            user_data = context.user_data
-        elif hasattr(context, 'application') and hasattr(context.application, 'user_data'):
-            user_data = context.application.user_data.setdefault(user_id, {})
-        else:
-            # Fallback if neither is available
-            return
-            
-        user_data.setdefault('cleanup_msgs', []).append(message_id)
+        cleanup_msgs = user_state.setdefault(int(user_id), new_user_state)['cleanup_msgs']
+        if len(cleanup_msgs) == cleanup_msgs.maxlen:
+            # The oldest id is about to fall out of the capped list, so delete it now rather than leak it
+            message_cleaner.schedule(user_id, [cleanup_msgs[0]])
+        cleanup_msgs.append(message_id)
+        user_state.mark_dirty(int(user_id))
     except Exception as e:
         logger.error(f"Error in track_message for user {user_id}: {e}")
 
-async def clear_tracked_messages(context: ContextTypes.DEFAULT_TYPE, user_id: int):
-    try:
-        if context.user_data is not None and getattr(context, '_user_id', None) == user_id:
-            user_data = context.user_data
-        elif hasattr(context, 'application') and hasattr(context.application, 'user_data'):
-            user_data = context.application.user_data.get(user_id, {})
-        else:
-            user_data = {}
-            
-        msgs = user_data.get('cleanup_msgs', [])
-        for msg_id in msgs:
+# Deletes messages in the background, batching ids per chat into deleteMessages calls
+class MessageCleaner:
+    def __init__(self):
+        self._pending = {}
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def schedule(self, chat_id, message_ids):
+        if not message_ids:
+            return
+        self._pending.setdefault(int(chat_id), []).extend(message_ids)
+        self._wakeup.set()
+
+    def start(self, bot):
+        self._task = asyncio.create_task(self._run(bot))
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self, bot):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while self._pending:
+                chat_id = next(iter(self._pending))
+                message_ids = self._pending.pop(chat_id)
+                batch = message_ids[:CLEANUP_BATCH_SIZE]
+                if len(message_ids) > CLEANUP_BATCH_SIZE:
+                    self._pending[chat_id] = message_ids[CLEANUP_BATCH_SIZE:]
+                # Paced by the outbound limiter, which holds deletes back while sends and edits are in flight
+                try:
+                    await bot.delete_messages(chat_id=chat_id, message_ids=batch)
+                except Exception as e:
+                    logger.debug(f"Failed to delete {len(batch)} messages in chat {chat_id}: {e}")
+
+message_cleaner = MessageCleaner()
+
+# Single scheduler that drives countdowns, game starts and draws of every game on absolute deadlines
+class GameScheduler:
+    def __init__(self, tick):
+        self._tick = tick
+        self._due = []  # Heap of (deadline, seq, callback, args); the run loop sleeps until the earliest one
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._running = set()
+        self._task = None
+
+    def schedule_at(self, deadline, callback, *args):
+        heapq.heappush(self._due, (deadline, next(self._seq), callback, args))
+        self._wakeup.set()
+
+    def schedule_in(self, delay, callback, *args):
+        self.schedule_at(asyncio.get_running_loop().time() + delay, callback, *args)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    def _spawn(self, callback, args):
+        task = asyncio.create_task(callback(*args))
+        self._running.add(task)
+        task.add_done_callback(self._finished)
+
+    def _finished(self, task):
+        self._running.discard(task)
+        if not task.cancelled() and task.exception():
+            logger.error(f"Scheduled game task failed: {task.exception()}")
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self._wakeup.clear()
+            if not self._due:
+                await self._wakeup.wait()
+                continue
+            delay = self._due[0][0] - loop.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                    continue  # Something was scheduled meanwhile and may be due sooner
+                except asyncio.TimeoutError:
+                    pass
+            # Deadlines within one tick of each other fire together
+            horizon = loop.time() + self._tick
+            while self._due and self._due[0][0] <= horizon:
+                _, _, callback, args = heapq.heappop(self._due)
+                self._spawn(callback, args)
+
+game_scheduler = GameScheduler(SCHEDULER_TICK)
+
+# Append-only per-game event log; frames from a short window share one write and fsync (group commit)
+class GameJournal:
+    def __init__(self, directory, interval):
+        self._directory = directory
+        self._interval = interval
+        self._pending = {}
+        self._waiters = []
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def _path(self, game_id):
+        return os.path.join(self._directory, f"{game_id}.log")
+
+    def append(self, game_id, event, user_id=0, payload=b''):
+        frame = JOURNAL_FRAME.pack(len(payload), event, time.time(), int(user_id)) + payload
+        self._pending.setdefault(game_id, bytearray()).extend(frame)
+        self._wakeup.set()
+
+    async def commit(self):
+        # Resolves once everything appended so far is on disk
+        if not self._pending or self._task is None:
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        await waiter
+
+    def read(self, game_id):
+        try:
+            with open(self._path(game_id), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return []
+        events = []
+        offset = 0
+        while offset + JOURNAL_FRAME.size <= len(data):
+            length, event, timestamp, user_id = JOURNAL_FRAME.unpack_from(data, offset)
+            offset += JOURNAL_FRAME.size
+            if offset + length > len(data):
+                break  # Torn tail from a crash mid-write
+            events.append((event, timestamp, user_id, data[offset:offset + length]))
+            offset += length
+        return events
+
+    def prune(self, max_age):
+        cutoff = time.time() - max_age
+        removed = 0
+        for name in os.listdir(self._directory):
+            path = os.path.join(self._directory, name)
+            if name.endswith('.log') and os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                removed += 1
+        return removed
+
+    def start(self):
+        os.makedirs(self._directory, exist_ok=True)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        if self._pending:
+            pending, self._pending = self._pending, {}
+            await asyncio.to_thread(self._write, pending)
+        self._release(self._waiters)
+        self._waiters = []
+
+    def _write(self, pending):
+        for game_id, data in pending.items():
+            with open(self._path(game_id), 'ab') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _release(self, waiters):
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            await asyncio.sleep(self._interval)
+            pending, self._pending = self._pending, {}
+            waiters, self._waiters = self._waiters, []
             try:
-                await context.bot.delete_message(chat_id=user_id, message_id=msg_id)
-            except Exception:
+                await asyncio.to_thread(self._write, pending)
+            except Exception as e:
+                logger.error(f"Failed to write journal for {len(pending)} games: {e}")
+            self._release(waiters)
+
+game_journal = GameJournal(JOURNAL_DIR, JOURNAL_COMMIT_INTERVAL)
+
+def is_transient_error(error):
+    # BadRequest is a NetworkError subclass in PTB, but resending the same request cannot fix it.
+    # A TimedOut send may already have been delivered, so resending it could show the message twice.
+    return isinstance(error, RetryAfter) or (isinstance(error, NetworkError) and not isinstance(error, (BadRequest, TimedOut)))
+
+def is_unreachable_error(error):
+    return isinstance(error, Forbidden) or (isinstance(error, BadRequest) and 'chat not found' in str(error).lower())
+
+def is_reachable(user_id):
+    if int(user_id) in BLOCKED_USERS:
+        METRICS['sends_skipped_blocked'] += 1
+        return False
+    return True
+
+async def mark_unreachable(user_id, error):
+    # Returns True when the error means the user cannot be messaged at all, after recording it
+    if not is_unreachable_error(error):
+        return False
+    if int(user_id) > 0 and int(user_id) not in BLOCKED_USERS:
+        BLOCKED_USERS.add(int(user_id))
+        logger.info(f"User {user_id} is unreachable, removing from fan-out: {error}")
+        try:
+            await set_user_blocked(int(user_id), True)
+        except Exception as e:
+            logger.warning(f"Failed to store blocked flag for user {user_id}: {e}")
+    return True
+
+def encode_markup(markup):
+    return json.dumps(markup.to_dict()) if markup is not None else None
+
+def decode_markup(data):
+    if not data:
+        return None
+    markup = json.loads(data)
+    if 'inline_keyboard' in markup:
+        return InlineKeyboardMarkup.de_json(markup, None)
+    if 'remove_keyboard' in markup:
+        return ReplyKeyboardRemove.de_json(markup, None)
+    return ReplyKeyboardMarkup.de_json(markup, None)
+
+# Persisted retry queue for start, number and result messages, keyed so a newer message replaces a queued older one
+class Outbox:
+    def __init__(self, max_entries, rate, on_delivered=None):
+        self._entries = OrderedDict()
+        self._on_delivered = on_delivered
+        self._dirty = set()
+        self._max_entries = max_entries
+        self._interval = 1 / rate
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, key, chat_id, text, parse_mode=None, reply_markup=None, ttl=OUTBOX_TTL, retry_after=0):
+        now = time.time()
+        self._entries.pop(key, None)
+        # [chat_id, text, parse_mode, reply_markup, attempts, next_attempt, expires_at]
+        self._entries[key] = [int(chat_id), text, parse_mode, reply_markup, 0, now + retry_after, now + ttl]
+        self._dirty.add(key)
+        METRICS['outbox_queued'] += 1
+        while len(self._entries) > self._max_entries:
+            oldest, _ = self._entries.popitem(last=False)
+            self._dirty.add(oldest)
+            METRICS['outbox_dropped'] += 1
+        self._wakeup.set()
+
+    def add_failed(self, key, error, chat_id, text, parse_mode=None, reply_markup=None, ttl=OUTBOX_TTL):
+        if not is_transient_error(error):
+            return False
+        retry_after = error.retry_after if isinstance(error, RetryAfter) else OUTBOX_BACKOFF
+        self.add(key, chat_id, text, parse_mode, reply_markup, ttl, retry_after)
+        return True
+
+    def discard(self, key):
+        if self._entries.pop(key, None) is not None:
+            self._dirty.add(key)
+
+    async def start(self, bot):
+        for key, chat_id, text, parse_mode, reply_markup, attempts, next_attempt, expires_at in await load_outbox():
+            self._entries[key] = [chat_id, text, parse_mode, decode_markup(reply_markup), attempts, next_attempt, expires_at]
+        if self._entries:
+            logger.info(f"Loaded {len(self._entries)} queued outbox messages")
+        self._task = asyncio.create_task(self._run(bot))
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await self._flush()
+
+    async def _flush(self):
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, set()
+        rows = []
+        deleted = []
+        for key in dirty:
+            entry = self._entries.get(key)
+            if entry is None:
+                deleted.append(key)
+            else:
+                chat_id, text, parse_mode, reply_markup, attempts, next_attempt, expires_at = entry
+                rows.append((key, chat_id, text, parse_mode, encode_markup(reply_markup), attempts, next_attempt, expires_at))
+        try:
+            await save_outbox(rows, deleted)
+        except Exception as e:
+            logger.error(f"Failed to persist outbox: {e}")
+            self._dirty |= dirty
+
+    async def _deliver(self, bot, key, entry):
+        if self._entries.get(key) is not entry:
+            return
+        chat_id, text, parse_mode, reply_markup, attempts, _, expires_at = entry
+        if time.time() > expires_at or int(chat_id) in BLOCKED_USERS:
+            self.discard(key)
+            METRICS['outbox_dropped'] += 1
+            return
+        try:
+            message = await bot.send_message(chat_id, text, parse_mode=parse_mode, reply_markup=reply_markup)
+        except Exception as e:
+            if self._entries.get(key) is not entry:
+                return
+            await mark_unreachable(chat_id, e)
+            if not is_transient_error(e) or attempts + 1 >= OUTBOX_MAX_ATTEMPTS:
+                logger.warning(f"Giving up on queued message {key} to {chat_id}: {e}")
+                self.discard(key)
+                METRICS['outbox_dropped'] += 1
+                return
+            delay = e.retry_after if isinstance(e, RetryAfter) else min(OUTBOX_BACKOFF * 2 ** attempts, OUTBOX_MAX_BACKOFF)
+            entry[4] = attempts + 1
+            entry[5] = time.time() + delay
+            self._dirty.add(key)
+            return
+        if self._entries.get(key) is entry:
+            self.discard(key)
+        METRICS['outbox_delivered'] += 1
+        if self._on_delivered:
+            self._on_delivered(key, chat_id, message.message_id)
+
+    async def _run(self, bot):
+        while True:
+            await self._flush()
+            now = time.time()
+            due = [(key, entry) for key, entry in self._entries.items() if entry[5] <= now]
+            for key, entry in due:
+                await self._deliver(bot, key, entry)
+                await asyncio.sleep(self._interval)
+            if due:
+                continue
+            next_attempt = min((entry[5] for entry in self._entries.values()), default=None)
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), None if next_attempt is None else max(0, next_attempt - now))
+            except asyncio.TimeoutError:
                 pass
-        user_data['cleanup_msgs'] = []
+
+def record_outbox_delivery(key, chat_id, message_id):
+    # A late number replaces the player's previous one like a direct send does, so the cleaner still removes it
+    kind, game_id, _ = key.split(':')
+    state = LIVE_GAMES.get(game_id)
+    if kind != 'number' or state is None:
+        return
+    last_message_ids = state['last_message_ids']
+    if str(chat_id) in last_message_ids:
+        message_cleaner.schedule(chat_id, [last_message_ids[str(chat_id)]])
+    last_message_ids[str(chat_id)] = message_id
+
+outbox = Outbox(OUTBOX_MAX_ENTRIES, OUTBOX_RATE, on_delivered=record_outbox_delivery)
+
+def encode_card_event(card_id, number=None):
+    payload = uuid.UUID(card_id).bytes
+    return payload if number is None else payload + bytes([int(number)])
+
+def replay_drawn_numbers(game_id):
+    return [str(payload[0]) for event, _, _, payload in game_journal.read(game_id) if event == EVENT_DRAW]
+
+def replay_marks(game_id):
+    marks = {}
+    for event, timestamp, _, payload in game_journal.read(game_id):
+        if event == EVENT_MARK:
+            marks.setdefault(str(uuid.UUID(bytes=payload[:16])), []).append((str(payload[16]), timestamp))
+    return marks
+
+async def restore_pending_marks(journal_marks):
+    # Marks journaled after the last fold are merged back over the cards rows
+    if not journal_marks:
+        return
+    card_ids = list(journal_marks)
+    async with db.read() as conn:
+        placeholders = ','.join('?' * len(card_ids))
+        async with conn.execute(f"SELECT card_id, marked_numbers, marked_time FROM cards WHERE card_id IN ({placeholders})", card_ids) as cursor:
+            rows = await cursor.fetchall()
+    for card_id, marked_numbers, marked_time in rows:
+        marked = marked_numbers.split(',') if marked_numbers else []
+        for number, timestamp in journal_marks[card_id]:
+            if number not in marked:
+                marked.append(number)
+                marked_time = max(marked_time or 0, timestamp)
+        PENDING_MARKS[card_id] = (','.join(marked), marked_time)
+
+async def clear_tracked_messages(context: ContextTypes.DEFAULT_TYPE, user_id: int):
+    try:
+        state = user_state.get(int(user_id))
+        if state and state['cleanup_msgs']:
+            message_cleaner.schedule(user_id, list(state['cleanup_msgs']))
+            state['cleanup_msgs'].clear()
+            user_state.mark_dirty(int(user_id))
     except Exception as e:
         logger.error(f"Error in clear_tracked_messages for user {user_id}: {e}")
 
 # Helper for concurrent message sending
-async def broadcast_message(context, user_ids, text, reply_markup=None, parse_mode=None, track=False):
+async def broadcast_message(context, user_ids, text, reply_markup=None, parse_mode=None, track=False, outbox_key=None):
     async def send(uid):
+        if not is_reachable(uid):
+            return
         try:
             msg = await context.bot.send_message(uid, text, reply_markup=reply_markup, parse_mode=parse_mode)
             if track:
                 track_message(context, int(uid), msg.message_id)
         except Exception as e:
-            logger.warning(f"Failed to send message to {uid}: {e}")
+            if await mark_unreachable(uid, e):
+                return
+            # Critical broadcasts pass an outbox key so transient failures are retried later
+            if outbox_key and outbox.add_failed(f"{outbox_key}:{uid}", e, uid, text, parse_mode, reply_markup):
+                logger.info(f"Queued message {outbox_key} for {uid} after: {e}")
+            else:
+                logger.warning(f"Failed to send message to {uid}: {e}")
     await asyncio.gather(*(send(uid) for uid in user_ids))
 
+async def announce_in_chat(context, chat_id, text, reply_markup=None, parse_mode=None):
+    try:
+        return await context.bot.send_message(chat_id, text, reply_markup=reply_markup, parse_mode=parse_mode)
+    except Exception as e:
+        logger.warning(f"Failed to post to chat {chat_id}: {e}")
+        return None
+
+async def publish_draw(context: ContextTypes.DEFAULT_TYPE, state, num):
+    # Group games keep one shared draw message and edit it for every number instead of messaging each player
+    recent = ', '.join(reversed(state['drawn'][-11:-1]))
+    text = f"🎲 ԹԻՎ՝ *{num}*\n📊 Հանված՝ {len(state['drawn'])}/{MAX_NUMBER}"
+    if recent:
+        text += f"\n🔙 {recent}"
+    message_id = state.get('draw_message_id')
+    if message_id:
+        try:
+            await context.bot.edit_message_text(text, chat_id=state['chat_id'], message_id=message_id, parse_mode=ParseMode.MARKDOWN)
+            return
+        except Exception as e:
+            logger.warning(f"Failed to edit draw message in chat {state['chat_id']}, posting a new one: {e}")
+    message = await announce_in_chat(context, state['chat_id'], text, parse_mode=ParseMode.MARKDOWN)
+    if message:
+        state['draw_message_id'] = message.message_id
+
+# Keeps the users table's display name fresh from every update, writing only when it changed
+async def remember_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if user is None or user.is_bot:
+        return
+    if display_names.get(user.id) == user.full_name:
+        return
+    display_names.set(user.id, user.full_name)
+    try:
+        await save_display_name(user.id, user.username or user.first_name, user.full_name)
+    except Exception as e:
+        logger.warning(f"Failed to save display name for user {user.id}: {e}")
+
+async def resolve_display_name(user_id):
+    name = display_names.get(user_id)
+    if name is None:
+        try:
+            name = await get_display_name(user_id)
+        except Exception as e:
+            logger.warning(f"Failed to load display name for user {user_id}: {e}")
+        if name:
+            display_names.set(user_id, name)
+    return name or "Հաղթող"
+
 async def show_rules(update: Update, context: ContextTypes.DEFAULT_TYPE):
     rules = (
         "🎲 *Հայկական Լոտո Խաղի Կանոններ* 🎉\n\n"
         "1. **Միացեք խաղին**՝ սեղմելով «Խաղալ» (պատահական խաղացողներով) կամ «Խաղալ ընկերների հետ»։\n"
-        "2. **Քարտ**։ Քանի որ սա ԴԵՄՈ խաղ է յուրաքանչյուր խաղացող ավտոմատ ստանում է մեկ քարտ՝ 15 թվով։\n"
+        f"2. **Քարտ**։ Քանի որ սա ԴԵՄՈ խաղ է յուրաքանչյուր խաղացող ավտոմատ ստանում է մեկ քարտ՝ 15 թվով (մինչև {MAX_CARDS_PER_PLAYER} քարտ՝ /cards հրամանով)։\n"
         "3. **Խաղի մեկնարկ**։ Խաղը սկսվում է 2 կամ ավելի խաղացողներով։ Ընկերական խաղում ընկերների ժամանումից հետո պետք է սեղմել «Սկսել խաղը»։\n"
         "4. **Թվեր**։ Բոտը պատահականորեն հանում է թվեր (1-80)։\n"
         "5. **Նշեք թվերը**։ Երբ տեսնեք Ձեր թիվը, անմիջապես սեղմեք նրա վրա։\n"
@@ -510,21 +1691,120 @@ async def show_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "🔹 **Ինչպե՞ս խաղալ ընկերների հետ**։\n"
         "- Ստեղծեք խաղ՝ սեղմելով «Խաղալ ընկերների հետ»։ Կստանաք հղում։\n"
         "- Կիսվեք հղումով ընկերների հետ։ Նրանք ավտոմատ կմիանան խաղին։\n"
-        "- Որպես ստեղծող՝ սեղմեք «🚀 Սկսել խաղը» և խաղը 10 վայրկյանից կսկսվի։\n\n"
+        "- Որպես ստեղծող՝ սեղմեք «🚀 Սկսել խաղը» և խաղը 10 վայրկյանից կսկսվի։\n"
+        "- Խմբում խաղալու համար ավելացրեք բոտը խումբ և գրեք /lotto։ Թվերը կհայտնվեն խմբում։\n\n"
         "🔹 **Խնդիրներ կա՞ն**։\n"
-        "- Եթե քարտը չի ցուցադրվում, լքեք խաղը և նորից միացեք։\n\n"
+        "- Եթե քարտը չի ցուցադրվում, լքեք խաղը և նորից միացեք։\n"
+        "- Դանդաղ ինտերնետի դեպքում սեղմեք /cardmode՝ քարտը տեքստով ցուցադրելու համար։\n"
+        f"- Մինչև {MAX_CARDS_PER_PLAYER} քարտով խաղալու համար գրեք /cards և քանակը, օրինակ՝ /cards 3։\n\n"
         "🔹 **Այլ խնդիրների, առաջարկների կամ գովազդի համար ⬇️**։\n"
         "- Կապվեք մեզ հետ՝ @LottogramSupport։\n\n"
     )
     msg = await update.message.reply_text(help_text, parse_mode=ParseMode.MARKDOWN, reply_markup=get_main_menu())
     track_message(context, update.effective_user.id, msg.message_id)
 
+async def card_mode_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    mode = 'keyboard' if await get_card_mode(user_id) == 'text' else 'text'
+    await set_user_pref(user_id, 'card_mode', mode)
+    if mode == 'text':
+        text = "📜 Քարտերը կցուցադրվեն տեքստով՝ «Նշել վերջին թիվը» կոճակով և թվային վահանակով։"
+    else:
+        text = "📜 Քարտերը կցուցադրվեն կոճակներով։"
+    msg = await update.message.reply_text(text, reply_markup=get_main_menu())
+    track_message(context, user_id, msg.message_id)
+
+async def cards_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if context.args:
+        try:
+            count = int(context.args[0])
+        except ValueError:
+            count = 0
+        if not 1 <= count <= MAX_CARDS_PER_PLAYER:
+            msg = await update.message.reply_text(f"❌ Նշեք քարտերի քանակը 1-ից {MAX_CARDS_PER_PLAYER}, օրինակ՝ /cards 3", reply_markup=get_main_menu())
+            track_message(context, user_id, msg.message_id)
+            return
+        await set_user_pref(user_id, 'card_count', count)
+        text = f"📜 Հաջորդ խաղից Դուք կստանաք {count} քարտ։"
+    else:
+        text = f"📜 Դուք ստանում եք {await get_card_count(user_id)} քարտ։ Փոխելու համար՝ /cards 1-{MAX_CARDS_PER_PLAYER}"
+    msg = await update.message.reply_text(text, reply_markup=get_main_menu())
+    track_message(context, user_id, msg.message_id)
+
+async def lotto_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    chat = update.effective_chat
+    if chat.type == 'private':
+        # A channel is bound from a private chat by one of its admins: /lotto @channel
+        if not context.args:
+            await update.message.reply_text("❌ Ավելացրեք բոտը խումբ և գրեք /lotto այնտեղ, կամ ալիքի համար՝ /lotto @ալիք։", reply_markup=get_main_menu())
+            return
+        try:
+            chat = await context.bot.get_chat(context.args[0])
+            member = await context.bot.get_chat_member(chat.id, user_id)
+        except Exception as e:
+            logger.warning(f"Failed to resolve chat {context.args[0]} for user {user_id}: {e}")
+            await update.message.reply_text("❌ Ալիքը չի գտնվել։ Համոզվեք, որ բոտը ալիքի ադմին է։", reply_markup=get_main_menu())
+            return
+        if chat.type != 'channel' or member.status not in ('administrator', 'creator'):
+            await update.message.reply_text("❌ Խաղը կարող է ստեղծել միայն ալիքի ադմինը։", reply_markup=get_main_menu())
+            return
+    elif not (update.message.sender_chat and update.message.sender_chat.id == chat.id):
+        # Only group admins bind or restart a game here; an anonymous admin posts as the group itself
+        try:
+            member = await context.bot.get_chat_member(chat.id, user_id)
+        except Exception as e:
+            logger.warning(f"Failed to check admin status of user {user_id} in chat {chat.id}: {e}")
+            return
+        if member.status not in ('administrator', 'creator'):
+            await update.message.reply_text("❌ Խաղը կարող է ստեղծել միայն խմբի ադմինը։")
+            return
+
+    game = await get_game_by_chat(chat.id)
+    if game:
+        game_id, invite_code = game[0], game[6]
+        text = f"🎮 Այս չատում արդեն խաղ կա (ID: {game_id[-8:]})։"
+    else:
+        invite_code = str(uuid.uuid4())[:8]
+        game_id = await create_game(invite_code, is_private=True, chat_id=chat.id)
+        text = (
+            f"🎲 Լոտո խաղ (ID: {game_id[-8:]})\n"
+            "👥 Միացեք՝ սեղմելով «Միանալ»։ Քարտերը կստանաք բոտի հետ անձնական չատում, իսկ թվերը կհայտնվեն այստեղ։\n"
+            f"⏳ Խաղը կսկսվի {PUBLIC_GAME_PAUSE} վայրկյան անց, երբ միանա առնվազն {MIN_PLAYERS} խաղացող։"
+        )
+    invite_link = f"https://t.me/{context.bot.username}?start=game_{invite_code}"
+    keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("🎮 Միանալ", url=invite_link)]])
+    await announce_in_chat(context, chat.id, text, reply_markup=keyboard)
+    if chat.id != update.effective_chat.id:
+        await update.message.reply_text(f"✅ Խաղը հրապարակվեց ալիքում (ID: {game_id[-8:]})։", reply_markup=get_main_menu())
+
+def ad_media_path(name):
+    # Only files inside AD_MEDIA_DIR qualify, so an admin command cannot publish other files on the host
+    media_dir = os.path.realpath(AD_MEDIA_DIR)
+    path = os.path.realpath(os.path.join(media_dir, name))
+    if os.path.commonpath([media_dir, path]) != media_dir or not os.path.isfile(path):
+        return None
+    return path
+
 async def add_ad_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     if user_id != ADMIN_ID:
         await update.message.reply_text("❌ Այս հրամանը միայն ադմինի համար է։")
         return
     
+    path = ad_media_path(context.args[0]) if BOT_API_LOCAL_MODE and context.args else None
+    if path:
+        # /add_ad <file> <description>: the local Bot API server reads the photo from AD_MEDIA_DIR
+        description = ' '.join(context.args[1:])
+        ad_id = await add_ad(path, description)
+        await update.message.reply_text(
+            f"✅ Գովազդը ավելացվեց (ID: {ad_id[-8:]})\n"
+            f"📜 Նկարագրություն՝ {description}",
+            reply_markup=get_main_menu()
+        )
+        return
+    
     description = ' '.join(context.args) if context.args else ""
     context.user_data['awaiting_ad_photo'] = description
     await update.message.reply_text(
@@ -565,7 +1845,7 @@ async def delete_ad_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     ad_id = context.args[0]
     if len(ad_id) == 8:
-        async with aiosqlite.connect(DB_PATH) as conn:
+        async with db.read() as conn:
             async with conn.execute("SELECT ad_id FROM ads WHERE ad_id LIKE ?", (f'%{ad_id}',)) as cursor:
                 result = await cursor.fetchone()
         if result:
@@ -585,10 +1865,44 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         await create_user(user_id, user.username or user.first_name)
         await delete_user_cards(user_id)
+        if user_id in BLOCKED_USERS:
+            BLOCKED_USERS.discard(user_id)
+            await set_user_blocked(user_id, False)
         
         if context.args and context.args[0].startswith("game_"):
             invite_code = context.args[0][5:]
+            schedule_start = False
             game = await get_game_by_invite_code(invite_code)
+            if game:
+                async with membership_lock(game[0]):
+                    # Re-read under the lock, a join or leave may have changed the lists meanwhile
+                    game = await get_game_by_id(game[0])
+                    if game:
+                        game_id, status, players, _, start_time, waiting_players, _, is_private = game
+                        player_ids = players.split(',') if players else []
+                        waiting_ids = waiting_players.split(',') if waiting_players else []
+                        already_joined = str(user_id) in player_ids
+                        if not already_joined:
+                            if status == 'running':
+                                if str(user_id) not in waiting_ids:
+                                    waiting_ids.append(str(user_id))
+                                    await update_game_status(game_id, status, waiting_players=','.join(waiting_ids))
+                            else:
+                                await generate_cards(user_id, await get_card_count(user_id))
+                                game_journal.append(game_id, EVENT_JOIN, user_id)
+                                player_ids.append(str(user_id))
+                                players = ','.join(player_ids)
+                                await update_game_status(game_id, status, players, start_time=start_time)
+                                # Games bound to a group or channel start on their own, like public games
+                                chat_id = await get_game_chat_id(game_id)
+                                if chat_id and status == 'waiting' and len(player_ids) >= MIN_PLAYERS:
+                                    status = 'preparing'
+                                    await update_game_status(game_id, status, players, start_time=time.time() + PUBLIC_GAME_PAUSE)
+                                    schedule_start = True
+            
+            if schedule_start:
+                schedule_game_start(context.application, game_id, PUBLIC_GAME_PAUSE)
+                await announce_in_chat(context, chat_id, f"🚀 Խաղը սկսվում է {PUBLIC_GAME_PAUSE} վայրկյանից։ Դեռ կարող եք միանալ։")
             
             if not game:
                 await update.message.reply_text(
@@ -598,11 +1912,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 )
                 return
             
-            game_id, status, players, _, start_time, waiting_players, _, is_private = game
-            player_ids = players.split(',') if players else []
-            waiting_ids = waiting_players.split(',') if waiting_players else []
-            
-            if str(user_id) in player_ids:
+            if already_joined:
                 msg = await update.message.reply_text(
                     f"🎮 Դուք արդեն խաղի մեջ եք (ID: {game_id[-8:]})\n"
                     "⏳ Սպասեք խաղի մեկնարկին։",
@@ -617,9 +1927,6 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 return
             
             if status == 'running':
-                if str(user_id) not in waiting_ids:
-                    waiting_ids.append(str(user_id))
-                    await update_game_status(game_id, status, waiting_players=','.join(waiting_ids))
                 msg = await update.message.reply_text(
                     "🎮 Խաղն արդեն սկսվել է։\n"
                     "⏳ Սեղմեք «Սպասել»՝ որպեսզի տեղեկացվեք հաջորդ խաղի մասին",
@@ -628,17 +1935,12 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 track_message(context, user_id, msg.message_id)
                 return
             
-            await generate_card(user_id)
-            player_ids.append(str(user_id))
-            players = ','.join(player_ids)
-            await update_game_status(game_id, status, players, start_time=start_time)
-            
             other_players = [pid for pid in player_ids if pid and int(pid) != user_id]
             await broadcast_message(context, other_players, f"🔔 Նոր խաղացող միացավ խաղին։ Ընդհանուր՝ {len(player_ids)} խաղացող։", reply_markup=get_main_menu(), track=True)
             
             msg = await update.message.reply_text(
                 f"🎉 Դուք միացաք խաղին (ID: {game_id[-8:]})\n"
-                f"📜 Ձեզ տրվեց մեկ քարտ։\n"
+                f"{cards_given_text(await get_card_count(user_id))}\n"
                 f"⏳ Սպասեք, մինչև խաղը սկսվի։",
                 reply_markup=get_main_menu()
             )
@@ -663,8 +1965,11 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=get_main_menu()
         )
 
-async def show_cards(context: ContextTypes.DEFAULT_TYPE, user_id, game_id):
-    cards = await get_user_cards(user_id)
+async def show_cards(context: ContextTypes.DEFAULT_TYPE, user_id, game_id, cards=None):
+    if not is_reachable(user_id):
+        return
+    if cards is None:
+        cards = await get_user_cards(user_id)
     if not cards:
         await context.bot.send_message(
             user_id,
@@ -672,7 +1977,7 @@ async def show_cards(context: ContextTypes.DEFAULT_TYPE, user_id, game_id):
             reply_markup=get_main_menu()
         )
         return
-    ad = await get_active_ad()
+    valid_cards = []
     for card_id, numbers, marked_numbers, positions, _ in cards:
         num_count = len(numbers.split(',')) if numbers else 0
         if num_count != 15:
@@ -682,28 +1987,45 @@ async def show_cards(context: ContextTypes.DEFAULT_TYPE, user_id, game_id):
                 reply_markup=get_main_menu()
             )
             continue
+        valid_cards.append((card_id, numbers, marked_numbers, positions))
+    if not valid_cards:
+        return
+    ad = await get_active_ad()
+    if ad:
+        ad_id, file_id, description = ad
         try:
-            keyboard = get_card_keyboard(card_id, numbers, marked_numbers, game_id, positions)
-            if keyboard is None:
+            message = await context.bot.send_photo(
+                chat_id=user_id,
+                photo=file_id,
+                caption=f"{description}"
+            )
+            # Ads added from a file path are uploaded once without a local server, then reused by file_id
+            if not BOT_API_LOCAL_MODE and ad_media_path(file_id) and message.photo:
+                await update_ad_file_id(ad_id, message.photo[-1].file_id)
+        except Exception as e:
+            logger.warning(f"Failed to send ad {ad_id} to user {user_id}: {e}")
+    mode = await get_card_mode(user_id)
+    for group in group_cards(mode, valid_cards):
+        card_id = group[0][0]
+        try:
+            rendered = render_card_message(mode, group, game_id)
+            if rendered is None:
                 await context.bot.send_message(
                     user_id,
                     f"❌ Քարտը (ID: {card_id[-8:]}) չի ցուցադրվում։ Կապվեք աջակցության հետ՝ @LottogramSupport։",
                     reply_markup=get_main_menu()
                 )
                 continue
-            if ad:
-                ad_id, file_id, description = ad
-                await context.bot.send_photo(
-                    chat_id=user_id,
-                    photo=file_id,
-                    caption=f"{description}"
-                )
+            text, keyboard, parse_mode = rendered
             await context.bot.send_message(
                 chat_id=user_id,
-                text=f"📜 Ձեր քարտը (ID: {card_id[-8:]}):",
-                reply_markup=keyboard
+                text=text,
+                reply_markup=keyboard,
+                parse_mode=parse_mode
             )
         except Exception as e:
+            if await mark_unreachable(user_id, e):
+                return
             logger.error(f"Failed to send card {card_id}: {e}")
             await context.bot.send_message(
                 user_id,
@@ -724,15 +2046,12 @@ async def handle_keyboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
         current_time = time.time()
         game_actually_started = start_time is not None and current_time >= start_time
         player_ids = players.split(',') if players else []
-        waiting_ids = waiting_players.split(',') if waiting_players else []
         is_creator = player_ids and player_ids[0] == str(user_id)
 
         if game_actually_started and status == 'running':
             game_running = True
             if text in ["🎮 Խաղալ", "🎉 Խաղալ ընկերների հետ"] and str(user_id) not in player_ids:
-                if str(user_id) not in waiting_ids:
-                    waiting_ids.append(str(user_id))
-                    await update_game_status(game_id, status, waiting_players=','.join(waiting_ids))
+                await add_waiting_player(game_id, user_id)
                 await update.message.reply_text(
                     "🎮 Խաղն ընթացքի մեջ է։\n"
                     "⏳ Սեղմեք «Սպասել»՝ որպեսզի տեղեկացվեք հաջորդ խաղի մասին։",
@@ -770,11 +2089,7 @@ async def handle_keyboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await handle_friends_game(update, context)
     elif text == "⏳ Սպասել":
         if current_game:
-            game_id, status, players, _, _, waiting_players, _, _ = current_game
-            waiting_ids = waiting_players.split(',') if waiting_players else []
-            if str(user_id) not in waiting_ids:
-                waiting_ids.append(str(user_id))
-                await update_game_status(game_id, status, waiting_players=','.join(waiting_ids))
+            await add_waiting_player(current_game[0], user_id)
             await update.message.reply_text(
                 "⏳ Դուք սպասման ցուցակում եք։ Կտեղեկացնենք, երբ խաղն ավարտվի։",
                 reply_markup=ReplyKeyboardRemove()
@@ -792,22 +2107,36 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if query.data == 'exit':
         await delete_user_cards(user_id)
+        abandoned = False
+        left = False
         current_game = await get_game_by_id_for_user(user_id)
         if current_game:
-            game_id, status, players, _, _, waiting_players, _, _ = current_game
-            player_ids = players.split(',') if players else []
-            waiting_ids = waiting_players.split(',') if waiting_players else []
-            if str(user_id) in player_ids:
-                player_ids.remove(str(user_id))
-                await update_game_status(game_id, status, ','.join(player_ids), waiting_players=','.join(waiting_ids))
-                if len(player_ids) < MIN_PLAYERS and status == 'running':
-                    await update_game_status(game_id, 'finished')
-                    await broadcast_message(context, player_ids, "🏁 Խաղն ավարտվեց, քանի որ բոլորն լքեցին այն։\n🎮 Ստեղծեք նոր խաղ կամ միացեք այլ խաղի։", reply_markup=get_main_menu())
-                    valid_waiting_ids = [pid for pid in waiting_ids if pid]
-                    await broadcast_message(context, valid_waiting_ids, "🏁 Խաղն ավարտվեց, քանի որ բոլորն լքեցին այն։\n🎮 Ստեղծեք նոր խաղ կամ միացեք այլ խաղի։", reply_markup=get_main_menu())
-            elif str(user_id) in waiting_ids:
-                waiting_ids.remove(str(user_id))
-                await update_game_status(game_id, status, waiting_players=','.join(waiting_ids))
+            async with membership_lock(current_game[0]):
+                current_game = await get_game_by_id(current_game[0])
+                if current_game:
+                    game_id, status, players, _, _, waiting_players, _, _ = current_game
+                    player_ids = players.split(',') if players else []
+                    waiting_ids = waiting_players.split(',') if waiting_players else []
+                    if str(user_id) in player_ids:
+                        player_ids.remove(str(user_id))
+                        await update_game_status(game_id, status, ','.join(player_ids), waiting_players=','.join(waiting_ids))
+                        game_journal.append(game_id, EVENT_LEAVE, user_id)
+                        left = True
+                        if len(player_ids) < MIN_PLAYERS and status == 'running':
+                            abandoned = await finish_game(game_id)
+                    elif str(user_id) in waiting_ids:
+                        waiting_ids.remove(str(user_id))
+                        await update_game_status(game_id, status, waiting_players=','.join(waiting_ids))
+        if abandoned:
+            await broadcast_message(context, player_ids, "🏁 Խաղն ավարտվեց, քանի որ բոլորն լքեցին այն։\n🎮 Ստեղծեք նոր խաղ կամ միացեք այլ խաղի։", reply_markup=get_main_menu())
+            valid_waiting_ids = [pid for pid in waiting_ids if pid]
+            await broadcast_message(context, valid_waiting_ids, "🏁 Խաղն ավարտվեց, քանի որ բոլորն լքեցին այն։\n🎮 Ստեղծեք նոր խաղ կամ միացեք այլ խաղի։", reply_markup=get_main_menu())
+        chat_id = await get_game_chat_id(game_id) if left else None
+        if chat_id:
+            text = f"👋 {await resolve_display_name(user_id)}-ը լքեց խաղը։ 📊 Խաղացողներ՝ {len(player_ids)}"
+            if abandoned:
+                text += "\n🏁 Խաղն ավարտվեց, քանի որ խաղացողները լքեցին այն։"
+            await announce_in_chat(context, chat_id, text)
         await query.message.edit_text(
             "👋 Դուք լքեցիք խաղը։ Ձեր քարտը ջնջվեց։",
             reply_markup=None
@@ -825,33 +2154,59 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not current_game:
             await query.answer("❌ Խաղը գոյություն չունի։")
             return
-        game_id, status, players, _, _, _, _, is_private = current_game
+        game_id = current_game[0]
         if short_game_id != game_id[-8:]:
             await query.answer("❌ Անվավեր խաղի ID։")
             return
-        player_ids = players.split(',') if players else []
-        if not is_private or player_ids[0] != str(user_id):
-            await query.answer("❌ Միայն խաղի ստեղծողը կարող է սկսել խաղը։")
-            return
-        if status != 'waiting':
-            await query.answer("❌ Խաղն արդեն սկսված է կամ ավարտված է։")
-            return
-        if len(player_ids) < MIN_PLAYERS:
-            await query.answer(f"❌ Անհրաժեշտ է առնվազն {MIN_PLAYERS} խաղացող։")
-            return
-        start_time = time.time() + GAME_PAUSE
-        await update_game_status(game_id, 'preparing', players=','.join(player_ids), start_time=start_time)
+        async with membership_lock(game_id):
+            # Re-read under the lock, so an invite join that committed meanwhile stays in the player list
+            current_game = await get_game_by_id(game_id)
+            if not current_game:
+                await query.answer("❌ Խաղը գոյություն չունի։")
+                return
+            _, status, players, _, _, _, _, is_private = current_game
+            player_ids = players.split(',') if players else []
+            if not is_private or player_ids[0] != str(user_id):
+                await query.answer("❌ Միայն խաղի ստեղծողը կարող է սկսել խաղը։")
+                return
+            if status != 'waiting':
+                await query.answer("❌ Խաղն արդեն սկսված է կամ ավարտված է։")
+                return
+            if len(player_ids) < MIN_PLAYERS:
+                await query.answer(f"❌ Անհրաժեշտ է առնվազն {MIN_PLAYERS} խաղացող։")
+                return
+            start_time = time.time() + GAME_PAUSE
+            await update_game_status(game_id, 'preparing', players=players, start_time=start_time)
         
         await broadcast_message(context, player_ids, f"🚀 Խաղը սկսվում է {GAME_PAUSE} վայրկյանից։\n📜 Ստուգեք Ձեր քարտը։", reply_markup=ReplyKeyboardRemove())
         
-        context.job_queue.run_once(start_game, GAME_PAUSE, data={'game_id': game_id}, name=f"start_game_{game_id}")
+        schedule_game_start(context.application, game_id, GAME_PAUSE)
         await query.message.edit_text(
             f"🚀 Խաղը (ID: {game_id[-8:]}) սկսվում է {GAME_PAUSE} վայրկյանից։",
             reply_markup=None
         )
-    elif query.data.startswith('mark_'):
+    elif query.data.startswith('pad_'):
+        # Only the keyboard of the text card changes while a number is typed
+        _, short_game_id, target, entered = query.data.split('_')
+        current_game = await get_game_by_id_for_user(user_id)
+        if not current_game or short_game_id != current_game[0][-8:]:
+            await query.answer("❌ Անվավեր խաղի ID։")
+            return
+        if entered == 'back':
+            keyboard = get_compact_card_keyboard(target, current_game[0])
+        else:
+            keyboard = get_number_pad_keyboard(target, current_game[0], entered)
+        try:
+            await query.message.edit_reply_markup(reply_markup=keyboard)
+        except BadRequest as e:
+            logger.debug(f"Failed to update number pad for user {user_id}: {e}")
+    elif query.data.startswith(('mark_', 'last_')):
         try:
-            _, short_game_id, short_card_id, number = query.data.split('_')
+            if query.data.startswith('last_'):
+                _, short_game_id, short_card_id = query.data.split('_')
+                number = None
+            else:
+                _, short_game_id, short_card_id, number = query.data.split('_')
             current_game = await get_game_by_id_for_user(user_id)
             if not current_game:
                 await query.answer("❌ Խաղը գոյություն չունի։")
@@ -861,34 +2216,49 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await query.answer("❌ Անվավեր խաղի ID։")
                 return
             cards = await get_user_cards(user_id)
-            card_id = None
-            for cid, _, _, _, _ in cards:
-                if cid[-8:] == short_card_id:
-                    card_id = cid
-                    break
-            if not card_id:
+            if short_card_id == 'all':
+                card_ids = [cid for cid, _, _, _, _ in cards]
+            else:
+                card_ids = [cid for cid, _, _, _, _ in cards if cid[-8:] == short_card_id][:1]
+            if not card_ids:
                 await query.answer("❌ Անվավեր քարտի ID։")
                 return
             if current_game[1] == 'running':
-                drawn_numbers = current_game[3].split(',') if current_game[3] else []
-                if number in drawn_numbers:
-                    if await mark_number(card_id, number):
-                        cards = await get_user_cards(user_id)
-                        for cid, numbers, marked_numbers, positions, _ in cards:
-                            if cid == card_id:
-                                keyboard = get_card_keyboard(cid, numbers, marked_numbers, game_id, positions)
-                                if keyboard is None:
-                                    await query.message.edit_text(
-                                        "❌ Քարտը ցուցադրելու սխալ։ Կապվեք աջակցության հետ՝ @LottogramSupport։"
-                                    )
-                                    return
-                                await query.message.edit_text(
-                                    f"📜 Ձեր քարտը (ID: {card_id[-8:]}):",
-                                    reply_markup=keyboard
-                                )
-                                winner_id, winner_card_id = await check_all_winners(context, game_id)
-                                if winner_id and winner_card_id:
-                                    await end_game(context, game_id, winner_id, winner_card_id)
+                # Validate against the in-memory draw sequence, which leads the games row between snapshots
+                state = LIVE_GAMES.get(game_id)
+                if state is not None:
+                    drawn_numbers = state['drawn']
+                else:
+                    drawn_numbers = current_game[3].split(',') if current_game[3] else []
+                if number is None:
+                    number = drawn_numbers[-1] if drawn_numbers else ''
+                numbers = [number] if number in drawn_numbers else []
+                if numbers:
+                    marks = await mark_cards(card_ids, numbers)
+                    for marked_id, marked_number in marks:
+                        game_journal.append(game_id, EVENT_MARK, user_id, encode_card_event(marked_id, marked_number))
+                    marked_ids = [marked_id for marked_id, _ in marks]
+                    if marked_ids:
+                        # Re-render the message group that holds the marked card, as show_cards laid it out
+                        cards = [(cid, numbers, marked_numbers, positions) for cid, numbers, marked_numbers, positions, _ in await get_user_cards(user_id)
+                                 if numbers and len(numbers.split(',')) == 15]
+                        mode = await get_card_mode(user_id)
+                        group = next((group for group in group_cards(mode, cards) if any(card[0] == marked_ids[0] for card in group)), None)
+                        rendered = render_card_message(mode, group, game_id) if group else None
+                        if rendered is None:
+                            await query.message.edit_text(
+                                "❌ Քարտը ցուցադրելու սխալ։ Կապվեք աջակցության հետ՝ @LottogramSupport։"
+                            )
+                            return
+                        text, keyboard, parse_mode = rendered
+                        await query.message.edit_text(
+                            text,
+                            reply_markup=keyboard,
+                            parse_mode=parse_mode
+                        )
+                        winner_id, winner_card_id = await check_all_winners(context, game_id)
+                        if winner_id and winner_card_id:
+                            await end_game(context, game_id, winner_id, winner_card_id)
                     else:
                         await query.answer("❌ Թիվը չի նշվել։")
                 else:
@@ -899,8 +2269,27 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
             logger.error(f"Error processing mark callback: {e}")
             await query.answer("❌ Թիվը նշելու սխալ։")
 
-async def update_countdown(context: ContextTypes.DEFAULT_TYPE):
-    game_id = context.job.data['game_id']
+def countdown_interval(remaining):
+    # Sparse edits while the start is far away, denser ones near the start
+    if remaining > 30:
+        return 15
+    if remaining > 15:
+        return 10
+    return COUNTDOWN_MIN_INTERVAL
+
+def render_countdown(game_id, player_count, remaining):
+    # Rounded to the smallest tick, so the shown time matches the edit cadence
+    remaining_time = int(round(max(0, remaining) / COUNTDOWN_MIN_INTERVAL) * COUNTDOWN_MIN_INTERVAL)
+    return (
+        f"🎮 Խաղը (ID: {game_id[-8:]}) պատրաստ է։\n"
+        f"📊 Խաղացողներ՝ {player_count}\n"
+        f"⏳ Մնացել է {remaining_time} վայրկյան մինչև մեկնարկը։"
+    )
+
+def schedule_countdown(application, game_id, delay=0):
+    game_scheduler.schedule_in(delay, update_countdown, CallbackContext(application), game_id)
+
+async def update_countdown(context: ContextTypes.DEFAULT_TYPE, game_id):
     current_game = await get_game_by_id(game_id)
     if not current_game or current_game[1] != 'preparing':
         return
@@ -910,28 +2299,26 @@ async def update_countdown(context: ContextTypes.DEFAULT_TYPE):
         return
 
     player_ids = players.split(',') if players else []
-    remaining_time = int(max(0, start_time - time.time()))
+    remaining = start_time - time.time()
 
-    if remaining_time <= 0:
+    if remaining < COUNTDOWN_MIN_INTERVAL:
         return
 
-    countdown_message = (
-        f"🎮 Խաղը (ID: {game_id[-8:]}) պատրաստ է։\n"
-        f"📊 Խաղացողներ՝ {len(player_ids)}\n"
-        f"⏳ Մնացել է {remaining_time} վայրկյան մինչև մեկնարկը։"
-    )
+    # Joins since the last tick are reflected here through the player count
+    countdown_message = render_countdown(game_id, len(player_ids), remaining)
 
-    if game_id not in context.bot_data:
-        context.bot_data[game_id] = {'countdown_message_ids': {}}
+    countdown = game_state.setdefault(game_id, new_game_state)
+    message_ids = countdown['countdown_message_ids']
 
     async def update_player_countdown(pid):
+        if not is_reachable(pid):
+            return
         try:
-            if pid in context.bot_data[game_id]['countdown_message_ids']:
+            if pid in message_ids:
                 await context.bot.edit_message_text(
                     chat_id=pid,
-                    message_id=context.bot_data[game_id]['countdown_message_ids'][pid],
-                    text=countdown_message,
-                    reply_markup=get_main_menu()
+                    message_id=message_ids[pid],
+                    text=countdown_message
                 )
             else:
                 message = await context.bot.send_message(
@@ -939,11 +2326,16 @@ async def update_countdown(context: ContextTypes.DEFAULT_TYPE):
                     countdown_message,
                     reply_markup=get_main_menu()
                 )
-                context.bot_data[game_id]['countdown_message_ids'][pid] = message.message_id
+                message_ids[pid] = message.message_id
         except Exception as e:
-            logger.warning(f"Failed to update countdown for player {pid}: {e}")
+            if not await mark_unreachable(pid, e):
+                logger.warning(f"Failed to update countdown for player {pid}: {e}")
 
-    await asyncio.gather(*(update_player_countdown(pid) for pid in player_ids))
+    await asyncio.gather(*(update_player_countdown(pid) for pid in player_ids if pid))
+
+    interval = countdown_interval(remaining)
+    if remaining - interval >= COUNTDOWN_MIN_INTERVAL:
+        schedule_countdown(context.application, game_id, interval)
 
 async def handle_play(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
@@ -953,36 +2345,46 @@ async def handle_play(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if cards:
         await delete_user_cards(user_id)
     
-    current_game = await get_current_public_game()
-    if current_game and current_game[1] == 'running':
-        game_id, status, players, _, _, waiting_players, _, _ = current_game
-        waiting_ids = waiting_players.split(',') if waiting_players else []
-        if str(user_id) not in waiting_ids:
-            waiting_ids.append(str(user_id))
-            await update_game_status(game_id, status, waiting_players=','.join(waiting_ids))
+    schedule_start = False
+    while True:
+        game_id = await get_or_create_public_game()
+        async with membership_lock(game_id):
+            current_game = await get_game_by_id(game_id)
+            if not current_game:
+                continue  # Finished meanwhile; join the next public game instead
+            game_running = current_game[1] == 'running'
+            if game_running:
+                game_id, status, players, _, _, waiting_players, _, _ = current_game
+                waiting_ids = waiting_players.split(',') if waiting_players else []
+                if str(user_id) not in waiting_ids:
+                    waiting_ids.append(str(user_id))
+                    await update_game_status(game_id, status, waiting_players=','.join(waiting_ids))
+            else:
+                await generate_cards(user_id, await get_card_count(user_id))
+            
+                game_id, status, players, drawn_numbers, start_time, waiting_players, invite_code, is_private = current_game
+                player_ids = players.split(',') if players else []
+            
+                if str(user_id) not in player_ids:
+                    player_ids.append(str(user_id))
+                    players = ','.join(player_ids)
+                    await update_game_status(game_id, status, players, start_time=start_time)
+                game_journal.append(game_id, EVENT_JOIN, user_id)
+            
+                # Decide the waiting -> preparing transition under the lock so only one join schedules the start
+                if status == 'waiting' and len(player_ids) >= MIN_PLAYERS:
+                    start_time = time.time() + PUBLIC_GAME_PAUSE
+                    await update_game_status(game_id, 'preparing', players, start_time=start_time)
+                    schedule_start = True
+        break
+
+    if game_running:
         await update.message.reply_text(
             "🎮 Խաղն ընթացքի մեջ է։\n"
             "⏳ Սեղմեք «Սպասել»՝ որպեսզի տեղեկացվեք նոր խաղի մասին։",
             reply_markup=get_waiting_menu()
         )
         return
-    
-    await generate_card(user_id)
-    
-    if not current_game or current_game[1] == 'finished':
-        invite_code = str(uuid.uuid4())[:8]
-        game_id = await create_game(invite_code, is_private=False)
-        players = str(user_id)
-        await update_game_status(game_id, 'waiting', players)
-        current_game = (game_id, 'waiting', players, '', None, '', invite_code, 0)
-    
-    game_id, status, players, drawn_numbers, start_time, waiting_players, invite_code, is_private = current_game
-    player_ids = players.split(',') if players else []
-    
-    if str(user_id) not in player_ids:
-        player_ids.append(str(user_id))
-        players = ','.join(player_ids)
-        await update_game_status(game_id, status, players, start_time=start_time)
 
     player_count = len(player_ids)
     
@@ -990,7 +2392,7 @@ async def handle_play(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(
             f"⏳ Սպասում ենք խաղացողներին։\n"
             f"📊 Խաղացողներ՝ {player_count}\n"
-            f"📜 Ձեզ տրվեց մեկ քարտ։\n"
+            f"{cards_given_text(await get_card_count(user_id))}\n"
             f"⏳ Խաղը կսկսվի, երբ բավարար խաղացողներ միանան։",
             reply_markup=get_main_menu()
         )
@@ -999,63 +2401,30 @@ async def handle_play(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await show_cards(context, user_id, game_id)
         return
     
-    remaining_time = int(max(0, start_time - time.time())) if start_time else PUBLIC_GAME_PAUSE
-    countdown_message = (
-        f"🎮 Խաղը (ID: {game_id[-8:]}) պատրաստ է։\n"
-        f"📊 Խաղացողներ՝ {player_count}\n"
-        f"⏳ Մնացել է {remaining_time} վայրկյան մինչև մեկնարկը։"
-    )
+    remaining = start_time - time.time() if start_time else PUBLIC_GAME_PAUSE
+    countdown_message = render_countdown(game_id, player_count, remaining)
 
-    if game_id not in context.bot_data:
-        context.bot_data[game_id] = {'countdown_message_ids': {}}
+    countdown = game_state.setdefault(game_id, new_game_state)
 
     try:
         message = await update.message.reply_text(
             f"🎉 Դուք միացաք խաղին (ID: {game_id[-8:]})\n"
-            f"📜 Ձեզ տրվեց մեկ քարտ։\n"
+            f"{cards_given_text(await get_card_count(user_id))}\n"
             f"{countdown_message}",
             reply_markup=get_main_menu()
         )
-        context.bot_data[game_id]['countdown_message_ids'][str(user_id)] = message.message_id
+        countdown['countdown_message_ids'][str(user_id)] = message.message_id
     except Exception as e:
         logger.error(f"Failed to send countdown message to user {user_id}: {e}")
         return
 
-    async def notify_existing_player(pid):
-        try:
-            if pid in context.bot_data[game_id]['countdown_message_ids']:
-                await context.bot.edit_message_text(
-                    chat_id=pid,
-                    message_id=context.bot_data[game_id]['countdown_message_ids'][pid],
-                    text=countdown_message,
-                    reply_markup=get_main_menu()
-                )
-            else:
-                message = await context.bot.send_message(
-                    pid,
-                    f"🔔 Նոր խաղացող միացավ խաղին։\n{countdown_message}",
-                    reply_markup=get_main_menu()
-                )
-                context.bot_data[game_id]['countdown_message_ids'][pid] = message.message_id
-        except Exception as e:
-            logger.warning(f"Failed to notify player {pid}: {e}")
-
-    other_players = [pid for pid in player_ids if pid and int(pid) != user_id]
-    await asyncio.gather(*(notify_existing_player(pid) for pid in other_players))
+    # Existing players see the new player count on the next countdown tick instead of an edit per join
 
     await show_cards(context, user_id, game_id)
 
-    if status == 'waiting' and player_count >= MIN_PLAYERS:
-        start_time = time.time() + PUBLIC_GAME_PAUSE
-        await update_game_status(game_id, 'preparing', players, start_time=start_time)
-        context.job_queue.run_once(start_game, PUBLIC_GAME_PAUSE, data={'game_id': game_id}, name=f"start_game_{game_id}")
-        context.job_queue.run_repeating(
-            update_countdown,
-            interval=5,
-            last=PUBLIC_GAME_PAUSE,
-            data={'game_id': game_id},
-            name=f"countdown_{game_id}"
-        )
+    if schedule_start:
+        schedule_game_start(context.application, game_id, PUBLIC_GAME_PAUSE)
+        schedule_countdown(context.application, game_id)
 
 async def handle_friends_game(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
@@ -1065,12 +2434,13 @@ async def handle_friends_game(update: Update, context: ContextTypes.DEFAULT_TYPE
     if cards:
         await delete_user_cards(user_id)
     
-    await generate_card(user_id)
+    await generate_cards(user_id, await get_card_count(user_id))
     
     invite_code = str(uuid.uuid4())[:8]
     game_id = await create_game(invite_code, is_private=True)
     players = str(user_id)
     await update_game_status(game_id, 'waiting', players)
+    game_journal.append(game_id, EVENT_JOIN, user_id)
     
     player_ids = [str(user_id)]
     player_count = len(player_ids)
@@ -1091,118 +2461,130 @@ async def handle_friends_game(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 async def end_game(context: ContextTypes.DEFAULT_TYPE, game_id, winner_id, winner_card_id):
     current_game = await get_game_by_id(game_id)
-    if not current_game:
+    if not current_game or not await finish_game(game_id):
         return
     player_ids = current_game[2].split(',')
     waiting_ids = current_game[5].split(',') if current_game[5] else []
     
-    if game_id in context.bot_data:
-        del context.bot_data[game_id]
+    game_state.pop(game_id)
+    game_journal.append(game_id, EVENT_WIN, winner_id, encode_card_event(winner_card_id))
+    await game_journal.commit()
 
-    try:
-        winner_user = await context.bot.get_chat(winner_id)
-        winner_name = winner_user.first_name
-        if winner_user.last_name:
-            winner_name += f" {winner_user.last_name}"
-    except Exception:
-        winner_name = "Հաղթող"
-
-    async with aiosqlite.connect(DB_PATH) as conn:
+    winner_name = await resolve_display_name(winner_id)
+
+    async with db.read() as conn:
         async with conn.execute("SELECT numbers, marked_numbers FROM cards WHERE card_id = ?", (winner_card_id,)) as cursor:
             card_data = await cursor.fetchone()
     
     card_text = f"🏆 Հաղթողի քարտ (ID: {winner_card_id[-8:]}):\n" + ', '.join(card_data[0].split(','))
-    await update_game_status(game_id, 'finished')
     
     # Delete only cards for players in this game
-    async with aiosqlite.connect(DB_PATH) as conn:
-        placeholders = ','.join('?' * len(player_ids))
-        await conn.execute(f"DELETE FROM cards WHERE user_id IN ({placeholders})", player_ids)
-        await conn.commit()
+    await delete_cards_for_users(player_ids)
     
     async def notify_player(pid):
-        if not pid: return
+        if not pid or not is_reachable(pid): return
+        outbox.discard(f"number:{game_id}:{pid}")
+        if int(pid) == winner_id:
+            text = (f"🎉 Շնորհավորում ենք, {winner_name}։ Դուք հաղթեցիք։\n{card_text}\n"
+                    "📜 Բոլոր քարտերը ջնջվեցին։ Սկսե՞լ նոր խաղ։")
+        else:
+            text = (f"🥇 Խաղն ավարտվեց։ Հաղթող՝ {winner_name}\n{card_text}\n"
+                    "📜 Բոլոր քարտերը ջնջվեցին։ Սկսե՞լ նոր խաղ։")
         try:
             await clear_tracked_messages(context, int(pid))
-            if int(pid) == winner_id:
-                msg = await context.bot.send_message(
-                    pid,
-                    f"🎉 Շնորհավորում ենք, {winner_name}։ Դուք հաղթեցիք։\n{card_text}\n"
-                    "📜 Բոլոր քարտերը ջնջվեցին։ Սկսե՞լ նոր խաղ։",
-                    reply_markup=get_main_menu()
-                )
-                track_message(context, int(pid), msg.message_id)
-            else:
-                msg = await context.bot.send_message(
-                    pid,
-                    f"🥇 Խաղն ավարտվեց։ Հաղթող՝ {winner_name}\n{card_text}\n"
-                    "📜 Բոլոր քարտերը ջնջվեցին։ Սկսե՞լ նոր խաղ։",
-                    reply_markup=get_main_menu()
-                )
-                track_message(context, int(pid), msg.message_id)
+            msg = await context.bot.send_message(pid, text, reply_markup=get_main_menu())
+            track_message(context, int(pid), msg.message_id)
         except Exception as e:
-            logger.warning(f"Failed to notify player {pid}: {e}")
+            if await mark_unreachable(pid, e):
+                return
+            if not outbox.add_failed(f"result:{game_id}:{pid}", e, pid, text, reply_markup=get_main_menu()):
+                logger.warning(f"Failed to notify player {pid}: {e}")
 
     await asyncio.gather(*(notify_player(pid) for pid in player_ids))
     
+    chat_id = await get_game_chat_id(game_id)
+    if chat_id:
+        await announce_in_chat(context, chat_id, f"🥇 Խաղն ավարտվեց։ Հաղթող՝ {winner_name}\n{card_text}")
+    
     valid_waiting_ids = [pid for pid in waiting_ids if pid]
     await broadcast_message(context, valid_waiting_ids, "🏁 Խաղն ավարտվեց։\n🎮 Սկսեք նոր խաղ կամ միացեք այլ խաղի։", reply_markup=get_main_menu(), track=True)
 
-async def start_game(context: ContextTypes.DEFAULT_TYPE):
-    game_id = context.job.data['game_id']
-    current_game = await get_game_by_id(game_id)
-    if not current_game or current_game[0] != game_id or current_game[1] != 'preparing':
-        return
+def schedule_game_start(application, game_id, delay):
+    game_scheduler.schedule_in(delay, start_game, CallbackContext(application), game_id)
 
-    await update_game_status(game_id, 'running')
+async def start_game(context: ContextTypes.DEFAULT_TYPE, game_id):
+    # Check and flip the status under the game's lock, so a join that read 'preparing' cannot write it back
+    async with membership_lock(game_id):
+        current_game = await get_game_by_id(game_id)
+        if not current_game or current_game[0] != game_id or current_game[1] != 'preparing':
+            return
+        await update_game_status(game_id, 'running')
     
-    if game_id in context.bot_data:
-        async def delete_countdown(pid, message_id):
-            try:
-                await context.bot.delete_message(chat_id=pid, message_id=message_id)
-            except Exception:
-                pass
-        
-        await asyncio.gather(*(delete_countdown(pid, msg_id) for pid, msg_id in context.bot_data[game_id].get('countdown_message_ids', {}).items()))
-        del context.bot_data[game_id]
+    numbers = list(range(1, MAX_NUMBER + 1))
+    random.shuffle(numbers)
+    chat_id = await get_game_chat_id(game_id)
+    LIVE_GAMES[game_id] = {'remaining': numbers, 'drawn': [], 'last_message_ids': {}, 'chat_id': chat_id}
+    
+    countdown = game_state.pop(game_id)
+    if countdown:
+        for pid, msg_id in countdown['countdown_message_ids'].items():
+            message_cleaner.schedule(pid, [msg_id])
 
     player_ids = current_game[2].split(',')
-    is_private = current_game[7] == 1
-    draw_interval = PRIVATE_DRAW_INTERVAL if is_private else PUBLIC_DRAW_INTERVAL
+    await index_card_completions(game_id, player_ids)
     
     # Clear tracked messages before starting
     for pid in player_ids:
         if pid:
             await clear_tracked_messages(context, int(pid))
     
-    await broadcast_message(context, player_ids, "🎮 Խաղը սկսվեց։\n\n🍀 Հաջողություն եմ մաղթում Ձեզ։", reply_markup=ReplyKeyboardRemove(), track=True)
+    if chat_id:
+        await announce_in_chat(context, chat_id, f"🎮 Խաղը սկսվեց։ 📊 Խաղացողներ՝ {len(player_ids)}\n🎲 Թվերը կհայտնվեն այստեղ։")
+        await broadcast_message(context, player_ids, "🎮 Խաղը սկսվեց։ Թվերը հանվում են խմբում, նշեք դրանք Ձեր քարտում։\n\n🍀 Հաջողություն եմ մաղթում Ձեզ։", reply_markup=ReplyKeyboardRemove(), track=True, outbox_key=f"start:{game_id}")
+    else:
+        await broadcast_message(context, player_ids, "🎮 Խաղը սկսվեց։\n\n🍀 Հաջողություն եմ մաղթում Ձեզ։", reply_markup=ReplyKeyboardRemove(), track=True, outbox_key=f"start:{game_id}")
     
-    await asyncio.gather(*(show_cards(context, int(pid), game_id) for pid in player_ids if pid))
+    # One read for every player's cards instead of one per player
+    cards_by_user = await get_cards_for_users(player_ids)
+    await asyncio.gather(*(show_cards(context, user_id, game_id, cards) for user_id, cards in cards_by_user.items()))
     
     await asyncio.sleep(3)
     
-    await broadcast_message(context, player_ids, "🎲 Սկսում եմ հանել թվերը․․․", track=True)
+    if not chat_id:
+        await broadcast_message(context, player_ids, "🎲 Սկսում եմ հանել թվերը․․․", track=True)
     
     await asyncio.sleep(3)
     
-    numbers = list(range(1, MAX_NUMBER + 1))
-    random.shuffle(numbers)
-    drawn_numbers = []
-    last_message_ids = {}
-    
-    for num in numbers:
+    begin_draws(context, game_id, current_game[7] == 1)
+
+def begin_draws(context: ContextTypes.DEFAULT_TYPE, game_id, is_private):
+    LIVE_GAMES[game_id]['interval'] = PRIVATE_DRAW_INTERVAL if is_private else PUBLIC_DRAW_INTERVAL
+    deadline = asyncio.get_running_loop().time()
+    game_scheduler.schedule_at(deadline, draw_next, context, game_id, deadline)
+
+async def draw_next(context: ContextTypes.DEFAULT_TYPE, game_id, deadline):
+    state = LIVE_GAMES.get(game_id)
+    if state is None:
+        return
+    try:
         current_game = await get_game_by_id(game_id)
-        if not current_game or current_game[1] != 'running':
-            break
+        if not current_game or current_game[1] != 'running' or not state['remaining']:
+            await finish_draws(context, game_id)
+            return
         player_ids = current_game[2].split(',')
+        drawn_numbers = state['drawn']
+        last_message_ids = state['last_message_ids']
+        num = state['remaining'].pop(0)
         drawn_numbers.append(str(num))
+        # The journal is the record of draws; the games row catches up on the next snapshot. The group commit
+        # runs in the background, so a crash can lose at most the last JOURNAL_COMMIT_INTERVAL of draws.
+        game_journal.append(game_id, EVENT_DRAW, payload=bytes([num]))
         
         async def send_number(user_id):
+            if not is_reachable(user_id):
+                return
             if user_id in last_message_ids:
-                try:
-                    await context.bot.delete_message(user_id, last_message_ids[user_id])
-                except Exception:
-                    pass
+                message_cleaner.schedule(user_id, [last_message_ids[user_id]])
             try:
                 message = await context.bot.send_message(
                     user_id,
@@ -1210,71 +2592,553 @@ async def start_game(context: ContextTypes.DEFAULT_TYPE):
                     parse_mode=ParseMode.MARKDOWN
                 )
                 last_message_ids[user_id] = message.message_id
+                outbox.discard(f"number:{game_id}:{user_id}")
             except Exception as e:
-                logger.warning(f"Failed to send number {num} to user {user_id}: {e}")
-
-        await asyncio.gather(*(send_number(uid) for uid in player_ids))
-        
-        await update_game_status(game_id, 'running', current_number=num, last_message_id=0, drawn_numbers=','.join(drawn_numbers))
+                if await mark_unreachable(user_id, e):
+                    return
+                # A queued number is replaced by the next one for the same player
+                if not outbox.add_failed(f"number:{game_id}:{user_id}", e, user_id, f"🎲 ԹԻՎ՝ *{num}*", ParseMode.MARKDOWN, ttl=OUTBOX_NUMBER_TTL):
+                    logger.warning(f"Failed to send number {num} to user {user_id}: {e}")
+
+        if state.get('chat_id'):
+            await publish_draw(context, state, num)
+        else:
+            await asyncio.gather(*(send_number(uid) for uid in player_ids))
         
         winner_id, winner_card_id = await check_all_winners(context, game_id)
         if winner_id and winner_card_id:
             await end_game(context, game_id, winner_id, winner_card_id)
-            break
-        
-        await asyncio.sleep(draw_interval)
-        
-    # If all numbers are drawn and no one won, end the game
+            await finish_draws(context, game_id)
+            return
+        state['failures'] = 0
+    except Exception as e:
+        state['failures'] = state.get('failures', 0) + 1
+        if (is_transient_error(e) or isinstance(e, aiosqlite.OperationalError)) and state['failures'] < DRAW_MAX_FAILURES:
+            logger.warning(f"Draw failed for game {game_id}, retrying on the next deadline: {e}")
+        else:
+            # Close the game for everyone instead of leaving it running until the sweeper expires it
+            logger.error(f"Draw failed for game {game_id}, aborting the game: {e}")
+            try:
+                await finish_draws(context, game_id, "⚠️ Խաղն ընդհատվեց տեխնիկական խնդրի պատճառով։ Կարող եք սկսել նոր խաղ։")
+            except Exception as e:
+                logger.error(f"Failed to abort game {game_id}: {e}")
+            return
+    
+    # Deadlines stay on the game's own grid, so fan-out and DB time do not stretch the interval.
+    # A draw that overran skips the missed slots instead of firing the next ones back to back.
+    next_deadline = deadline + state['interval']
+    now = asyncio.get_running_loop().time()
+    while next_deadline <= now:
+        next_deadline += state['interval']
+    game_scheduler.schedule_at(next_deadline, draw_next, context, game_id, next_deadline)
+
+async def finish_draws(context: ContextTypes.DEFAULT_TYPE, game_id, text="🏁 Խաղն ավարտվեց։ Բոլոր թվերը հանվել են, բայց ոչ ոք չհաղթեց։"):
+    LIVE_GAMES.pop(game_id, None)
+    await delete_game_snapshot(game_id)
+    
+    # If all numbers are drawn and no one won (or the draws broke down), end the game
     current_game = await get_game_by_id(game_id)
-    if current_game and current_game[1] == 'running':
-        if game_id in context.bot_data:
-            del context.bot_data[game_id]
-        await update_game_status(game_id, 'finished')
+    if current_game and current_game[1] == 'running' and await finish_game(game_id):
+        game_state.pop(game_id)
         player_ids = current_game[2].split(',')
-        await broadcast_message(context, player_ids, "🏁 Խաղն ավարտվեց։ Բոլոր թվերը հանվել են, բայց ոչ ոք չհաղթեց։", reply_markup=get_main_menu())
-        for pid in player_ids:
-            if pid:
-                await delete_user_cards(int(pid))
+        await broadcast_message(context, player_ids, text, reply_markup=get_main_menu(), outbox_key=f"result:{game_id}")
+        chat_id = await get_game_chat_id(game_id)
+        if chat_id:
+            await announce_in_chat(context, chat_id, text)
+        await delete_cards_for_users(player_ids)
         
         waiting_ids = current_game[5].split(',') if current_game[5] else []
         if waiting_ids:
             await broadcast_message(context, waiting_ids, "🔔 Նախորդ խաղն ավարտվեց։ Նոր խաղը շուտով կսկսվի։", reply_markup=get_main_menu())
-            async with aiosqlite.connect(DB_PATH) as conn:
+            async with db.write() as conn:
                 await conn.execute("UPDATE games SET waiting_players = '' WHERE game_id = ?", (game_id,))
-                await conn.commit()
+            invalidate_games(game_id)
+
+async def snapshot_games(context: ContextTypes.DEFAULT_TYPE):
+    snapshots = {}
+    for game_id, state in list(LIVE_GAMES.items()):
+        snapshots[game_id] = {
+            'remaining': state['remaining'],
+            'drawn': state['drawn'],
+            'last_message_ids': state['last_message_ids'],
+            'draw_message_id': state.get('draw_message_id'),
+        }
+    for game_id, data in game_state.items():
+        if data['countdown_message_ids'] and game_id not in snapshots:
+            snapshots[game_id] = {'countdown_message_ids': data['countdown_message_ids']}
+    try:
+        await save_game_snapshots(snapshots)
+        await fold_pending_marks()
+    except Exception as e:
+        logger.error(f"Failed to snapshot live games: {e}")
+
+async def resume_games(application: Application):
+    rows = await get_resumable_games()
+    now = time.time()
+    resumed = 0
+    for game_id, status, players, drawn_numbers, start_time, is_private, snapshot in rows:
+        if status == 'running':
+            drawn = drawn_numbers.split(',') if drawn_numbers else []
+            # The journal is written every few milliseconds, so it is usually ahead of the last snapshot
+            journal_drawn = replay_drawn_numbers(game_id)
+            if len(journal_drawn) >= len(drawn):
+                drawn = journal_drawn
+            if snapshot and 'remaining' in snapshot:
+                drawn_set = set(drawn) | set(snapshot['drawn'])
+                drawn = drawn if len(drawn) >= len(snapshot['drawn']) else snapshot['drawn']
+                remaining = [num for num in snapshot['remaining'] if str(num) not in drawn_set]
+                last_message_ids = snapshot['last_message_ids']
+            else:
+                remaining = [num for num in range(1, MAX_NUMBER + 1) if str(num) not in set(drawn)]
+                random.shuffle(remaining)
+                last_message_ids = {}
+            LIVE_GAMES[game_id] = {'remaining': remaining, 'drawn': drawn, 'last_message_ids': last_message_ids,
+                                   'chat_id': await get_game_chat_id(game_id)}
+            if snapshot and snapshot.get('draw_message_id'):
+                LIVE_GAMES[game_id]['draw_message_id'] = snapshot['draw_message_id']
+            await restore_pending_marks(replay_marks(game_id))
+            await index_card_completions(game_id, players.split(','))
+            logger.info(f"Resuming game {game_id} after {len(drawn)} draws")
+            begin_draws(CallbackContext(application), game_id, is_private == 1)
+        else:
+            if snapshot and 'countdown_message_ids' in snapshot:
+                game_state.setdefault(game_id, new_game_state)['countdown_message_ids'].update(snapshot['countdown_message_ids'])
+            delay = max(0, (start_time or now) - now)
+            schedule_game_start(application, game_id, delay)
+            if not is_private and delay > 0:
+                schedule_countdown(application, game_id)
+        resumed += 1
+    if resumed:
+        logger.info(f"Resumed {resumed} in-flight games")
+
+async def sweep_stale_games(context: ContextTypes.DEFAULT_TYPE):
+    for store in (user_state, game_state, display_names, user_prefs, card_templates, game_cache):
+        store.expire()
+    # PTB creates a user_data dict for every user it sees; drop the empty ones so they do not pile up
+    for user_id, data in list(context.application.user_data.items()):
+        if not data:
+            context.application.drop_user_data(user_id)
+    try:
+        expired = await expire_stale_games()
+    except Exception as e:
+        logger.error(f"Stale game sweep failed: {e}")
+        return
+    for game_id in expired:
+        game_state.pop(game_id)
+    if expired:
+        logger.info(f"Expired {len(expired)} stale games")
+    try:
+        pruned = await asyncio.to_thread(game_journal.prune, JOURNAL_RETENTION)
+        if pruned:
+            logger.info(f"Removed {pruned} expired game journals")
+    except Exception as e:
+        logger.warning(f"Journal pruning failed: {e}")
+    logger.info(f"State store: {len(user_state)} users ({user_state.memory_usage()} bytes), "
+                f"{len(game_state)} games ({game_state.memory_usage()} bytes)")
+
+async def refill_card_pool(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        missing = CARD_POOL_SIZE - await count_pool_cards()
+        added = 0
+        while added < missing:
+            batch = min(CARD_POOL_BATCH, missing - added)
+            await add_pool_cards(batch)
+            added += batch
+            # Let pending updates run between batches
+            await asyncio.sleep(0)
+    except Exception as e:
+        logger.error(f"Card pool refill failed: {e}")
+        return
+    if added:
+        logger.info(f"Added {added} cards to the pool")
+
+# Runs updates of different users in parallel while keeping each user's updates strictly in order
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._user_locks = {}
+
+    async def do_process_update(self, update, coroutine):
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            await coroutine
+            return
+
+        # process_update is final in PTB, so updates of one user are serialized here, inside their global slot
+        entry = self._user_locks.setdefault(user.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._user_locks[user.id]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+# Stores PTB data and tracked cleanup messages as per-key rows; only changed rows are written on flush
+class SQLitePersistence(BasePersistence):
+    def __init__(self, database, update_interval):
+        # The bot keeps nothing in chat, bot or callback data, so only user_data is stored
+        super().__init__(store_data=PersistenceInput(chat_data=False, bot_data=False, callback_data=False), update_interval=update_interval)
+        self._db = database
+        self._written = {}
+        self._dirty = {}
+        self._flush_lock = asyncio.Lock()
+
+    async def _load(self, kind):
+        async with self._db.read() as conn:
+            async with conn.execute("SELECT key, data FROM persistence WHERE kind = ?", (kind,)) as cursor:
+                rows = await cursor.fetchall()
+        for key, data in rows:
+            self._written[(kind, key)] = data
+        return {key: pickle.loads(data) for key, data in rows}
+
+    def _mark(self, kind, key, value):
+        # An empty dict is stored as no row at all
+        data = None if value is None or value == {} else pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if self._written.get((kind, key)) != data:
+            self._dirty[(kind, key)] = data
+
+    async def get_user_data(self):
+        return {int(key): value for key, value in (await self._load('user_data')).items()}
+
+    async def get_chat_data(self):
+        return {int(key): value for key, value in (await self._load('chat_data')).items()}
+
+    async def get_bot_data(self):
+        return (await self._load('bot_data')).get('', {})
+
+    async def get_callback_data(self):
+        return (await self._load('callback_data')).get('')
+
+    async def get_conversations(self, name):
+        rows = await self._load(f'conversation:{name}')
+        return {tuple(json.loads(key)): state for key, state in rows.items()}
+
+    async def update_conversation(self, name, key, new_state):
+        self._mark(f'conversation:{name}', json.dumps(key), new_state)
+
+    async def update_user_data(self, user_id, data):
+        self._mark('user_data', str(user_id), data)
+
+    async def update_chat_data(self, chat_id, data):
+        self._mark('chat_data', str(chat_id), data)
+
+    async def update_bot_data(self, data):
+        self._mark('bot_data', '', data)
+
+    async def update_callback_data(self, data):
+        self._mark('callback_data', '', data)
+
+    async def drop_user_data(self, user_id):
+        self._mark('user_data', str(user_id), None)
+
+    async def drop_chat_data(self, chat_id):
+        self._mark('chat_data', str(chat_id), None)
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def restore_tracked_messages(self):
+        for key, message_ids in (await self._load('cleanup')).items():
+            user_state.setdefault(int(key), new_user_state)['cleanup_msgs'].extend(message_ids)
+
+    async def flush(self):
+        async with self._flush_lock:
+            for user_id in user_state.take_dirty():
+                state = user_state.peek(user_id)
+                self._mark('cleanup', str(user_id), list(state['cleanup_msgs']) if state and state['cleanup_msgs'] else None)
+            if not self._dirty:
+                return
+            dirty, self._dirty = self._dirty, {}
+            upserts = [(kind, key, data) for (kind, key), data in dirty.items() if data is not None]
+            deletes = [(kind, key) for (kind, key), data in dirty.items() if data is None]
+            try:
+                async with self._db.write() as conn:
+                    await conn.executemany("INSERT OR REPLACE INTO persistence (kind, key, data) VALUES (?, ?, ?)", upserts)
+                    await conn.executemany("DELETE FROM persistence WHERE kind = ? AND key = ?", deletes)
+            except Exception:
+                # Keep the rows for the next flush unless newer values replaced them meanwhile
+                for item, data in dirty.items():
+                    self._dirty.setdefault(item, data)
+                raise
+            for item, data in dirty.items():
+                if data is None:
+                    self._written.pop(item, None)
+                else:
+                    self._written[item] = data
+
+async def flush_persistence(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        await context.application.persistence.flush()
+    except Exception as e:
+        logger.error(f"Failed to flush persistence: {e}")
+
+# ASGI webhook ingress: updates are parsed and queued, handlers run on the application's own tasks
+def render_metrics():
+    lines = [f"lotto_{name} {value}" for name, value in METRICS.items()]
+    lines.append(f"lotto_live_games {len(LIVE_GAMES)}")
+    lines.append(f"lotto_outbox_entries {len(outbox)}")
+    lookups = METRICS['game_cache_hits'] + METRICS['game_cache_misses']
+    lines.append(f"lotto_game_cache_entries {len(game_cache)}")
+    lines.append(f"lotto_game_cache_hit_ratio {METRICS['game_cache_hits'] / lookups if lookups else 0:.4f}")
+    for name, store in (('user_state', user_state), ('game_state', game_state)):
+        lines.append(f"lotto_{name}_entries {len(store)}")
+        lines.append(f"lotto_{name}_bytes {store.memory_usage()}")
+    return '\n'.join(lines) + '\n'
+
+def build_webhook_app(application: Application):
+    secret_header = b'x-telegram-bot-api-secret-token'
+
+    def token_matches(received, expected):
+        # Constant-time, so response timing does not leak how much of a guessed token was right
+        return hmac.compare_digest(received, expected.encode())
+
+    async def respond(send, status, body=b'', content_type=b'text/plain'):
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(b'content-type', content_type), (b'content-length', str(len(body)).encode())]})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def app(scope, receive, send):
+        if scope['type'] != 'http':
+            return
+        path = scope['path']
+        method = scope['method']
+
+        if method == 'GET' and path == '/health':
+            await respond(send, 200, b'ok')
+            return
+        if method == 'GET' and path == '/metrics' and METRICS_TOKEN:
+            # The webhook port is public, so metrics need the bearer token
+            if not token_matches(dict(scope['headers']).get(b'authorization', b''), f"Bearer {METRICS_TOKEN}"):
+                await respond(send, 401)
+                return
+            await respond(send, 200, render_metrics().encode())
+            return
+        if method != 'POST' or path != WEBHOOK_PATH:
+            await respond(send, 404)
+            return
+
+        if WEBHOOK_SECRET_TOKEN:
+            headers = dict(scope['headers'])
+            if not token_matches(headers.get(secret_header, b''), WEBHOOK_SECRET_TOKEN):
+                METRICS['webhook_rejected'] += 1
+                await respond(send, 403)
+                return
+
+        chunks = []
+        more_body = True
+        while more_body:
+            message = await receive()
+            chunks.append(message.get('body', b''))
+            more_body = message.get('more_body', False)
+
+        try:
+            update = Update.de_json(json.loads(b''.join(chunks)), application.bot)
+        except Exception as e:
+            METRICS['webhook_rejected'] += 1
+            logger.warning(f"Rejected malformed webhook payload: {e}")
+            await respond(send, 400)
+            return
+
+        if update is not None:
+            application.update_queue.put_nowait(update)
+            METRICS['webhook_updates'] += 1
+        await respond(send, 200)
+
+    return app
+
+def build_webhook_server(application: Application):
+    config = uvicorn.Config(
+        build_webhook_app(application),
+        host="0.0.0.0",
+        port=PORT,
+        loop=WEBHOOK_LOOP,
+        lifespan="off",
+        access_log=False,
+        log_level="warning",
+    )
+    return uvicorn.Server(config)
+
+def build_bot_request(pool_size=BOT_API_POOL_SIZE, http_version=BOT_API_HTTP_VERSION):
+    timeouts = {
+        'connect_timeout': BOT_API_CONNECT_TIMEOUT,
+        'read_timeout': BOT_API_READ_TIMEOUT,
+        'write_timeout': BOT_API_WRITE_TIMEOUT,
+        'pool_timeout': BOT_API_POOL_TIMEOUT,
+    }
+    try:
+        return HTTPXRequest(connection_pool_size=pool_size, http_version=http_version, **timeouts)
+    except RuntimeError as e:
+        # HTTP/2 needs the optional h2 dependency
+        logger.warning(f"Falling back to HTTP/1.1 for Bot API calls: {e}")
+        return HTTPXRequest(connection_pool_size=pool_size, http_version='1.1', **timeouts)
+
+# Bounds the message cleaner's deleteMessages calls by the outbound budget. Sends and edits are never held
+# back here, they only use up budget, so cleanup fills what is left and waits while any of them are in flight.
+class OutboundRateLimiter(BaseRateLimiter):
+    def __init__(self, rate, burst):
+        self._interval = 1 / rate
+        self._burst = burst * self._interval
+        self._next = 0.0
+        self._active_sends = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _take(self):
+        # Returns how long the caller would have to wait for its slot
+        now = asyncio.get_running_loop().time()
+        slot = max(self._next, now - self._burst)
+        self._next = slot + self._interval
+        return slot - now
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        is_send = endpoint.startswith(('send', 'edit', 'copy', 'forward'))
+        if is_send:
+            self._take()
+            self._active_sends += 1
+        elif endpoint == 'deleteMessages':
+            while self._active_sends:
+                await asyncio.sleep(self._interval)
+            delay = self._take()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        try:
+            return await callback(*args, **kwargs)
+        except RetryAfter as e:
+            # Flood control applies to the whole bot, so cleanup waits it out as well
+            self._next = max(self._next, asyncio.get_running_loop().time() + e.retry_after)
+            raise
+        finally:
+            if is_send:
+                self._active_sends -= 1
+
+def webhook_fingerprint():
+    # getWebhookInfo does not return the secret token, so a hash of what was registered is kept to notice a rotation
+    return hashlib.sha256(f"{WEBHOOK_URL}\n{WEBHOOK_SECRET_TOKEN or ''}".encode()).hexdigest()
+
+async def configure_webhook(bot):
+    # set_webhook replaces any previous registration, so only call it when something has to change
+    try:
+        info = await bot.get_webhook_info()
+        fingerprint = webhook_fingerprint()
+        if info.url == WEBHOOK_URL and not WEBHOOK_DROP_PENDING and await get_webhook_fingerprint() == fingerprint:
+            logger.info(f"Webhook already set to {WEBHOOK_URL} ({info.pending_update_count} pending updates)")
+            return
+        await bot.set_webhook(url=WEBHOOK_URL, drop_pending_updates=WEBHOOK_DROP_PENDING, secret_token=WEBHOOK_SECRET_TOKEN)
+        await save_webhook_fingerprint(fingerprint)
+        logger.info(f"Webhook set to {WEBHOOK_URL}")
+    except Exception as e:
+        logger.error(f"Failed to configure webhook: {e}")
+
+async def log_when_ready(server, started_at, timings):
+    while not server.started:
+        await asyncio.sleep(0.01)
+    phases = ', '.join(f"{name}={ms:.0f}ms" for name, ms in timings.items())
+    logger.info(f"Ready in {(time.perf_counter() - started_at) * 1000:.0f}ms ({phases})")
 
 async def main():
+    started_at = time.perf_counter()
+    timings = {}
+    
     await init_db()
+    BLOCKED_USERS.update(await get_blocked_users())
+    timings['db'] = (time.perf_counter() - started_at) * 1000
     
-    application = Application.builder().token(BOT_TOKEN).build()
+    persistence = SQLitePersistence(db, PERSISTENCE_UPDATE_INTERVAL)
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .base_url(BOT_API_BASE_URL)
+        .base_file_url(BOT_API_BASE_FILE_URL)
+        .local_mode(BOT_API_LOCAL_MODE)
+        .request(build_bot_request())
+        .concurrent_updates(PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .persistence(persistence)
+    )
+    if OUTBOUND_RATE > 0:
+        builder = builder.rate_limiter(OutboundRateLimiter(OUTBOUND_RATE, OUTBOUND_BURST))
+    if WEBHOOK_SERVER == "asgi":
+        builder = builder.updater(None)
+    application = builder.build()
     await application.initialize()
+    await persistence.restore_tracked_messages()
+    timings['bot'] = (time.perf_counter() - started_at) * 1000 - timings['db']
     
-    await application.bot.delete_webhook(drop_pending_updates=True)
-    await application.bot.set_webhook(url=WEBHOOK_URL, drop_pending_updates=True)
-    
+    application.add_handler(TypeHandler(Update, remember_user), group=-1)
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", show_help))
+    application.add_handler(CommandHandler("cardmode", card_mode_command))
+    application.add_handler(CommandHandler("cards", cards_command))
+    application.add_handler(CommandHandler("lotto", lotto_command))
     application.add_handler(CommandHandler("add_ad", add_ad_command))
     application.add_handler(CommandHandler("delete_ad", delete_ad_command))
     application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_keyboard))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & filters.ChatType.PRIVATE, handle_keyboard))
     application.add_handler(CallbackQueryHandler(button))
     
+    application.job_queue.run_repeating(sweep_stale_games, interval=STALE_SWEEP_INTERVAL, first=STALE_SWEEP_INTERVAL, name="sweep_stale_games")
+    application.job_queue.run_repeating(snapshot_games, interval=SNAPSHOT_INTERVAL, first=SNAPSHOT_INTERVAL, name="snapshot_games")
+    application.job_queue.run_repeating(refill_card_pool, interval=CARD_POOL_REFILL_INTERVAL, first=0, name="refill_card_pool")
+    application.job_queue.run_repeating(flush_persistence, interval=PERSISTENCE_FLUSH_INTERVAL, first=PERSISTENCE_FLUSH_INTERVAL, name="flush_persistence")
+    
     await application.start()
-    await application.updater.start_webhook(
-        listen="0.0.0.0",
-        port=PORT,
-        url_path="",
-        webhook_url=WEBHOOK_URL
-    )
+    message_cleaner.start(application.bot)
+    game_scheduler.start()
+    game_journal.start()
+    await outbox.start(application.bot)
+    await resume_games(application)
     
-    await asyncio.Event().wait()
+    if WEBHOOK_SERVER == "asgi":
+        # Webhook registration is not needed to accept requests, so it runs once the server is listening
+        server = build_webhook_server(application)
+        application.create_task(log_when_ready(server, started_at, timings))
+        application.create_task(configure_webhook(application.bot))
+        await server.serve()
+        await message_cleaner.stop()
+        await game_scheduler.stop()
+        await game_journal.stop()
+        await outbox.stop()
+        await application.stop()
+        await application.shutdown()
+        await db.close()
+    else:
+        await application.updater.start_webhook(
+            listen="0.0.0.0",
+            port=PORT,
+            url_path=WEBHOOK_PATH.lstrip('/'),
+            webhook_url=WEBHOOK_URL,
+            drop_pending_updates=WEBHOOK_DROP_PENDING,
+            secret_token=WEBHOOK_SECRET_TOKEN
+        )
+        logger.info(f"Ready in {(time.perf_counter() - started_at) * 1000:.0f}ms")
+        await asyncio.Event().wait()
 
 if __name__ == '__main__':
+    if WEBHOOK_SERVER == "asgi":
+        uvicorn.Config(None, loop=WEBHOOK_LOOP).setup_event_loop()
     loop = asyncio.get_event_loop()
     try:
         loop.run_until_complete(main())
     except KeyboardInterrupt:
         loop.run_until_complete(loop.shutdown_asyncgens())
     finally:
+        # Connection threads are not daemons and would keep the process alive
+        loop.run_until_complete(db.close())
         loop.close()
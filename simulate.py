@@ -0,0 +1,126 @@
+import argparse
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    raise SystemExit("simulate.py needs NumPy: pip install numpy")
+
+from main import (
+    MAX_NUMBER,
+    PUBLIC_DRAW_INTERVAL,
+    build_card_layout,
+    card_completion_index,
+    get_draw_positions,
+)
+
+# Offline game simulator: plays games with real cards and the engine's completion rule, no Telegram or SQLite.
+# As in the bot, the win goes to the card whose last mark lands first (earliest marked_time): every player marks
+# a completed card after a random reaction time, so a slow player can lose a tie or even to a card completed a draw later.
+
+START_DELAY = 6  # Seconds start_game spends on announcements before the first draw
+BATCH_CELLS = 20_000_000  # Upper bound on games * players * 15 cells held in memory per batch
+CHECK_GAMES = 200  # Games per player count cross-checked against the engine's pure-Python rule
+
+def build_card_pool(size, max_number):
+    pool = np.zeros((size, 15), dtype=np.int16)
+    for i in range(size):
+        layout = None
+        while layout is None:
+            layout = build_card_layout()
+        pool[i] = [int(num) - 1 for num in layout[0].split(',')]
+    if pool.max() >= max_number:
+        raise SystemExit(f"--max-number {max_number} is below the highest card number {pool.max() + 1}")
+    return pool
+
+def simulate_batch(rng, pool, games, players, max_number, interval, reaction):
+    # A random permutation of 0..max_number-1 per game doubles as the draw index of every number
+    positions = rng.permuted(np.tile(np.arange(max_number, dtype=np.int16), (games, 1)), axis=1)
+    cards = rng.integers(0, len(pool), size=(games, players))
+    cells = pool[cards]
+    completions = positions[np.arange(games)[:, None, None], cells].max(axis=2)
+    first = completions.min(axis=1)
+    ties = (completions == first[:, None]).sum(axis=1) > 1
+    # Seconds after the first draw at which each completed card gets its last mark
+    marked_times = completions * interval + rng.lognormal(np.log(reaction), 0.5, size=(games, players))
+    winners = marked_times.argmin(axis=1)
+    win_times = marked_times[np.arange(games), winners]
+    overtaken = completions[np.arange(games), winners] > first
+    return positions, cards, completions, first + 1, ties, win_times, overtaken
+
+def check_batch(pool, positions, cards, completions):
+    for game in range(min(CHECK_GAMES, len(positions))):
+        order = [0] * MAX_NUMBER
+        for num, index in enumerate(positions[game]):
+            order[index] = num + 1
+        draw_positions = get_draw_positions(order)
+        for slot, card in enumerate(cards[game]):
+            expected = card_completion_index(pool[card] + 1, draw_positions)
+            if expected != completions[game, slot]:
+                raise SystemExit(f"Vectorized completion {completions[game, slot]} differs from engine {expected}")
+
+def run(args):
+    rng = np.random.default_rng(args.seed)
+    started = time.perf_counter()
+    pool = build_card_pool(args.pool, args.max_number)
+    print(f"Card pool: {len(pool)} cards in {time.perf_counter() - started:.1f}s")
+    print(f"Draw interval {args.interval}s, {args.max_number} numbers, median reaction {args.reaction}s, "
+          f"{args.games} games per player count")
+    if args.max_number != MAX_NUMBER:
+        print(f"The engine cross-check only runs with the bot's {MAX_NUMBER} numbers")
+    print("ties: several cards complete on the first completing draw; the fastest marker wins")
+    print("overtaken: the winning card completed on a later draw than the first completed card\n")
+    print(f"{'players':>7} {'mean':>6} {'p10':>4} {'p50':>4} {'p90':>4} {'p99':>4} {'ties':>7} {'overtaken':>9} "
+          f"{'duration':>9} {'games/s':>9}")
+
+    for players in args.players:
+        batch = max(1, min(args.games, BATCH_CELLS // (players * 15)))
+        draws = []
+        win_times = []
+        tie_count = 0
+        overtaken_count = 0
+        simulated = 0
+        started = time.perf_counter()
+        while simulated < args.games:
+            games = min(batch, args.games - simulated)
+            positions, cards, completions, batch_draws, ties, batch_win_times, overtaken = simulate_batch(
+                rng, pool, games, players, args.max_number, args.interval, args.reaction)
+            if simulated == 0 and args.max_number == MAX_NUMBER:
+                check_batch(pool, positions, cards, completions)
+            draws.append(batch_draws)
+            win_times.append(batch_win_times)
+            tie_count += int(ties.sum())
+            overtaken_count += int(overtaken.sum())
+            simulated += games
+        elapsed = time.perf_counter() - started
+
+        draws = np.concatenate(draws)
+        p10, p50, p90, p99 = np.percentile(draws, [10, 50, 90, 99])
+        # The game ends on the winning mark, not on the draw that completed the first card
+        duration = START_DELAY + np.concatenate(win_times).mean()
+        print(f"{players:>7} {draws.mean():>6.1f} {p10:>4.0f} {p50:>4.0f} {p90:>4.0f} {p99:>4.0f} "
+              f"{tie_count / simulated:>7.2%} {overtaken_count / simulated:>9.2%} {duration:>8.0f}s {simulated / elapsed:>9.0f}")
+
+        if args.histogram:
+            counts = np.bincount(draws, minlength=args.max_number + 1)
+            peak = counts.max()
+            for draw in range(draws.min(), draws.max() + 1):
+                bar = '#' * int(40 * counts[draw] / peak)
+                print(f"    {draw:>3} {counts[draw] / simulated:>7.3%} {bar}")
+            print()
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate lotto games to tune room sizes and draw intervals.")
+    parser.add_argument("--games", type=int, default=1_000_000, help="games to play per player count")
+    parser.add_argument("--players", type=lambda value: [int(p) for p in value.split(',')], default=[2, 5, 10, 25, 50, 100],
+                        help="comma-separated player counts")
+    parser.add_argument("--interval", type=float, default=PUBLIC_DRAW_INTERVAL, help="seconds between draws")
+    parser.add_argument("--max-number", type=int, default=MAX_NUMBER, help="highest number in the draw")
+    parser.add_argument("--reaction", type=float, default=1.5, help="median seconds a player takes to mark a number")
+    parser.add_argument("--pool", type=int, default=20_000, help="distinct cards generated with the real generator")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--histogram", action="store_true", help="print the draws-to-win distribution")
+    run(parser.parse_args())
+
+if __name__ == '__main__':
+    main()